@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+#
+# Synthetic load generator and benchmark for the Verse master server. Runs a master
+# server Database in-process on top of a fake transport, drives it with generated
+# ANNOUNCE, DESCRIPTION and GET traffic, and reports per-message throughput, latency
+# percentiles, peak memory and packets sent. Results are written as JSON, so runs of
+# different versions can be compared.
+#
+# A suitable command-line might be:
+#
+# ./benchmark.py -o new.json -b old.json small 10k
+#
+
+import getopt
+import imp
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+MASTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "verse-master.py")
+
+# Named scenarios. Each is a set of traffic parameters:
+#  servers	Number of Verse servers that announce and describe themselves.
+#  clients	Number of clients, each from its own IP, sending GETs.
+#  gets		Number of GETs sent by each client.
+#  tags		Number of distinct tags in use; each server has zero to three of them.
+#  storms	Number of times every registered server re-announces, as after a restart.
+#  duplicate	Fraction of GETs that are the common 'IP=DE' query, rather than tag-filtered.
+#  descriptions	Number of distinct server descriptions. Defaults to one per server.
+#  repeats	Fraction of GETs that the client sends again right away, as on a lost packet.
+#  mtu		Datagram size for the master to pack lists into. Defaults to the master's.
+#  limited	Fraction of GETs that only ask for the 20 most recently seen servers.
+SCENARIOS = {
+	"small":	{ "servers": 1000,	"clients": 50,	"gets": 4, "tags": 8,	"storms": 1, "duplicate": 0.8 },
+	"10k":		{ "servers": 10000,	"clients": 100,	"gets": 4, "tags": 32,	"storms": 2, "duplicate": 0.8 },
+	"100k":		{ "servers": 100000,	"clients": 100,	"gets": 2, "tags": 64,	"storms": 1, "duplicate": 0.8 },
+	"retries":	{ "servers": 10000,	"clients": 100,	"gets": 2, "tags": 32,	"storms": 0, "duplicate": 0.8, "repeats": 0.5 },
+	"few":		{ "servers": 10000,	"clients": 100,	"gets": 4, "tags": 32,	"storms": 0, "duplicate": 0.8, "limited": 0.9 },
+	"memory":	{ "servers": 200000,	"clients": 0,	"gets": 0, "tags": 64,	"storms": 0, "duplicate": 0.0, "descriptions": 100 },
+}
+
+def load_master(path = MASTER):
+	"""Import the master server script as a module. The verse module is not needed."""
+	return imp.load_source("verse_master", path)
+
+class FakeTransport:
+	"""An in-process transport. Pings sent by the master are counted, and pings are delivered
+	   to it by calling deliver()."""
+	def __init__(self):
+		self.handler = None
+		self.packets = 0
+		self.bytes = 0
+
+	def open(self, port, handler):
+		self.handler = handler
+
+	def send(self, address, message):
+		self.packets += 1
+		self.bytes += len(message)
+
+	def wait(self, deadline):
+		pass
+
+	def deliver(self, address, message):
+		self.handler(address, message)
+
+class Recorder:
+	"""Collects latencies and packet counts per message type."""
+	def __init__(self, transport):
+		self.transport = transport
+		self.latency = {}
+		self.packets = {}
+		self.bytes = {}
+
+	def run(self, kind, address, message):
+		p, b = self.transport.packets, self.transport.bytes
+		t0 = time.time()
+		self.transport.deliver(address, message)
+		self.add(kind, time.time() - t0, p, b)
+
+	def add(self, kind, elapsed, packets, bytes):
+		self.latency.setdefault(kind, []).append(elapsed)
+		self.packets[kind] = self.packets.get(kind, 0) + self.transport.packets - packets
+		self.bytes[kind] = self.bytes.get(kind, 0) + self.transport.bytes - bytes
+
+	def report(self):
+		out = {}
+		for kind, lat in self.latency.items():
+			lat.sort()
+			total = sum(lat)
+			r = { "count": len(lat), "seconds": total, "packets": self.packets[kind], "bytes": self.bytes[kind] }
+			if total > 0.0:
+				r["per_second"] = len(lat) / total
+			for p in [50, 90, 99]:
+				r["p%u_us" % p] = 1e6 * lat[min(len(lat) - 1, len(lat) * p / 100)]
+			r["max_us"] = 1e6 * lat[-1]
+			out[kind] = r
+		return out
+
+def server_address(i):
+	"""Address of the i:th synthetic server; at most two servers share an IP."""
+	n = i / 2
+	return "10.%u.%u.%u:%u" % ((n >> 16) & 255, (n >> 8) & 255, n & 255, 4950 + (i & 1))
+
+def client_address(i):
+	return "192.168.%u.%u:%u" % ((i >> 8) & 255, i & 255, 5000 + i)
+
+def run_scenario(name, params, seed = 1):
+	"""Run one scenario, and return a dictionary of results."""
+	random.seed(seed)
+	vm = load_master()
+	period = vm.LIST_PERIOD
+	vm.LIST_PERIOD = 0.0		# Don't pace lists, we drain them right away.
+	transport = FakeTransport()
+	db = vm.Database(vm.VERSE_PORT, vm.LOG_ERROR, transport)
+	db.set_list_rate(1e12)
+	db.set_describe_rate(1e12)
+	db.set_limits(None)		# Synthetic servers are packed densely into few subnets.
+	if params.has_key("mtu"):
+		db.set_mtu(params["mtu"])
+	rec = Recorder(transport)
+	lists = []			# Number of packets in each list sent.
+	tags = ["tag%u" % i for i in xrange(params["tags"])]
+	descriptions = params.get("descriptions", params["servers"])
+
+	rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	t0 = time.time()
+	batch = vm.QUEUE_SIZE / 2	# Describe in batches, so the queue never fills.
+	for first in xrange(0, params["servers"], batch):
+		last = min(params["servers"], first + batch)
+		for i in xrange(first, last):
+			rec.run("ANNOUNCE", server_address(i), "MS:ANNOUNCE")
+		for i in xrange(first, last):
+			ta = ",".join(random.sample(tags, random.randint(0, min(3, len(tags)))))
+			rec.run("DESCRIPTION", server_address(i), 'DESCRIPTION DE="Synthetic server number %u" TA=%s' % (i % descriptions, ta))
+	rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	for s in xrange(params["storms"]):
+		for i in xrange(params["servers"]):
+			rec.run("ANNOUNCE_KNOWN", server_address(i), "MS:ANNOUNCE")
+	for g in xrange(params["gets"]):
+		for c in xrange(params["clients"]):
+			if random.random() < params["duplicate"]:
+				q = 'MS:GET IP=DE'
+			else:
+				q = 'MS:GET IP=DE TA=%s,-%s' % tuple(random.sample(tags, 2))
+			if random.random() < params.get("limited", 0.0):
+				q += ' MX=20 OR=SEEN'
+			rec.run("GET", client_address(c), q)
+			if len(db.listjobs.jobs) > 0:
+				lists.append(len(max(db.listjobs.jobs, key = lambda j: j[1])[2].packets))
+			if random.random() < params.get("repeats", 0.0):
+				rec.run("GET_REPEAT", client_address(c), q)
+		p, b = transport.packets, transport.bytes
+		t = time.time()
+		while db.listjobs.next_deadline() != None:
+			db.flush()
+		rec.add("LIST", time.time() - t, p, b)
+	wall = time.time() - t0
+
+	return {
+		"scenario": name,
+		"params": params,
+		"registered": len(db.servers),
+		"wall_seconds": wall,
+		"peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		"bytes_per_server": 1024.0 * (rss1 - rss0) / max(1, params["servers"]),
+		"packets_sent": transport.packets,
+		"bytes_sent": transport.bytes,
+		"messages": rec.report(),
+		"packets_per_get": float(sum(lists)) / max(1, len(lists)),
+		"packets_per_get_max": max(lists or [0]),
+		"full_list_seconds": period * sum([n - 1 for n in lists]) / max(1, len(lists)),
+		"full_list_seconds_max": period * (max(lists or [1]) - 1),
+	}
+
+def isolated(fn, *args):
+	"""Call fn(*args) in a child process, and return its result, which must be JSON-able. Peak
+	   memory is then measured for that call alone, and each call imports its own master."""
+	r, w = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(r)
+		sys.stdout = open(os.devnull, "w")	# The master talks a lot.
+		out = os.fdopen(w, "w")
+		json.dump(fn(*args), out)
+		out.close()
+		os._exit(0)
+	os.close(w)
+	data = os.fdopen(r).read()
+	os.waitpid(pid, 0)
+	return json.loads(data)
+
+def run_isolated(name, params):
+	"""Run a scenario in a child process."""
+	return isolated(run_scenario, name, params)
+
+def summarize_messages(messages, baseline = None):
+	"""Print a line per message type, with the change in throughput from a baseline if given."""
+	for kind in sorted(messages.keys()):
+		m = messages[kind]
+		line = "  %-15s %8u msgs %12.0f/s  p50 %8.1f us  p99 %8.1f us" % (kind, m["count"], m.get("per_second", 0), m["p50_us"], m["p99_us"])
+		if baseline != None and baseline["messages"].has_key(kind) and baseline["messages"][kind].get("per_second"):
+			line += "  %+6.1f%%" % (100.0 * (m.get("per_second", 0) / baseline["messages"][kind]["per_second"] - 1.0))
+		print >>sys.stderr, line
+
+def summarize(result, baseline = None):
+	"""Print a human-readable summary of a result, compared to a baseline result if given."""
+	print >>sys.stderr, "%s: %u registered, %.2f s, %u packets, peak RSS %u KB, %.0f bytes/server" % (result["scenario"],
+		result["registered"], result["wall_seconds"], result["packets_sent"], result["peak_rss_kb"], result["bytes_per_server"])
+	summarize_messages(result["messages"], baseline)
+	if result.get("packets_per_get", 0) > 0:
+		line = "  lists: %.2f packets per GET, %u max; full list after %.2f s, %.2f s max" % (result["packets_per_get"],
+			result["packets_per_get_max"], result["full_list_seconds"], result["full_list_seconds_max"])
+		if baseline != None and baseline.get("packets_per_get"):
+			line += "  %+6.1f%%" % (100.0 * (result["packets_per_get"] / baseline["packets_per_get"] - 1.0))
+		print >>sys.stderr, line
+
+def usage():
+	print "Verse Master Server benchmark. Usage: benchmark.py [options] [SCENARIO ...]"
+	print "Scenarios:", ", ".join(sorted(SCENARIOS.keys())) + ". Default is small."
+	print "Options:"
+	print " -h or --help\t\t\tThis text."
+	print " -o FILE or --output=FILE\tWrite JSON results to FILE, rather than stdout."
+	print " -b FILE or --baseline=FILE\tCompare with JSON results from an earlier run."
+	print " -s N or --servers=N\t\tOverride number of servers in all scenarios."
+	print " -c N or --clients=N\t\tOverride number of clients in all scenarios."
+	print " -m N or --mtu=N\t\tOverride datagram size for lists in all scenarios."
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "ho:b:s:c:m:", ["help", "output=", "baseline=", "servers=", "clients=", "mtu="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	output = None
+	baseline = {}
+	override = {}
+	for o, a in opts:
+		if o in ["-h", "--help"]:
+			usage()
+			sys.exit()
+		elif o in ["-o", "--output"]:
+			output = a
+		elif o in ["-b", "--baseline"]:
+			for r in json.load(open(a))["results"]:
+				baseline[r["scenario"]] = r
+		elif o in ["-s", "--servers"]:
+			override["servers"] = int(a)
+		elif o in ["-c", "--clients"]:
+			override["clients"] = int(a)
+		elif o in ["-m", "--mtu"]:
+			override["mtu"] = int(a)
+			vm = load_master()
+			if override["mtu"] < vm.MTU_MIN or override["mtu"] > vm.PACKET_MTU:
+				print >>sys.stderr, "MTU must be %u to %u" % (vm.MTU_MIN, vm.PACKET_MTU)
+				sys.exit(2)
+	if len(args) == 0:
+		args = ["small"]
+
+	results = []
+	for name in args:
+		if not SCENARIOS.has_key(name):
+			print >>sys.stderr, "Unknown scenario", name
+			sys.exit(2)
+		params = dict(SCENARIOS[name])
+		params.update(override)
+		r = run_isolated(name, params)
+		summarize(r, baseline.get(name))
+		results.append(r)
+
+	doc = { "version": load_master().VERSION, "time": time.time(), "results": results }
+	if output != None:
+		f = open(output, "w")
+		json.dump(doc, f, indent = 1, sort_keys = True)
+		f.close()
+	else:
+		json.dump(doc, sys.stdout, indent = 1, sort_keys = True)
+		print
+
+if __name__ == "__main__":
+	main()
@@ -3,12 +3,23 @@
 # A testing client for the Verse master server.
 #
 
+import marshal
+import os
+import Queue
 import socket
 import sys
+import threading
 import time
 
 import verse as v
 
+import msparse
+
+NAME_THREADS = 8		# Number of reverse look-ups done at once.
+NAME_TTL     = 24 * 3600.0	# Time a looked-up name is trusted, in seconds.
+NAME_TTL_MISS = 600.0		# Time a failed look-up is trusted.
+NAME_CACHE   = "~/.verse-ms-names"	# Default file to keep looked-up names in.
+
 quiet = False
 time0 = 0
 time1 = 0
@@ -26,18 +37,97 @@ def address_to_ip(address):
 	return ip
 	
 
+class Resolver:
+	"""Reverse look-ups of IP addresses, done by a pool of threads so the caller never waits.
+	   Names are kept, with an expiry time, in a file between runs."""
+	def __init__(self, path = None, threads = NAME_THREADS):
+		self.path = path
+		self.names = {}		# Maps IP to (name or None, expiry time).
+		self.lock = threading.Lock()
+		self.todo = Queue.Queue()
+		self.busy = set()	# IPs being looked up.
+		self.threads = threads
+		self.workers = []
+		if path != None:
+			try:
+				f = open(path, "rb")
+				self.names = marshal.load(f)
+				f.close()
+			except (IOError, EOFError, ValueError, TypeError):
+				pass
+
+	def lookup(self, ip):
+		"""Return (done, name), where name is None if the IP has none. Not done means that a
+		   look-up has been started; ask again later."""
+		now = time.time()
+		self.lock.acquire()
+		try:
+			hit = self.names.get(ip)
+			if hit != None and hit[1] > now:
+				return (True, hit[0])
+			if ip not in self.busy:
+				self.busy.add(ip)
+				self.todo.put(ip)
+				if len(self.workers) < min(self.threads, len(self.busy)):
+					t = threading.Thread(target = self._work)
+					t.daemon = True
+					t.start()
+					self.workers.append(t)
+			return (False, None)
+		finally:
+			self.lock.release()
+
+	def _work(self):
+		while 1:
+			ip = self.todo.get()
+			try:
+				name, ttl = socket.gethostbyaddr(ip)[0], NAME_TTL
+			except socket.error:
+				name, ttl = None, NAME_TTL_MISS
+			self.lock.acquire()
+			self.names[ip] = (name, time.time() + ttl)
+			self.busy.discard(ip)
+			self.lock.release()
+
+	def save(self):
+		if self.path == None:
+			return
+		now = time.time()
+		self.lock.acquire()
+		names = dict([(ip, hit) for ip, hit in self.names.iteritems() if hit[1] > now])
+		self.lock.release()
+		try:
+			f = open(self.path, "wb")
+			marshal.dump(names, f)
+			f.close()
+		except IOError, e:
+			print "Couldn't save names to %s: %s" % (self.path, e)
+
+
 class Listener:
 	def __init__(self):
 		self.created = time.time()
-		self.set_master("localhost:4950")
+		self.masters = []
+		self.done = set()	# Masters whose lists are complete.
+		self.add_master("localhost:4950")
 		self.single = False
 		self.set_duration(10.0)
 		self.set_raw(False)
 		self.set_lookup(False)
+		self.cache = None
+		self.limit = ""		# MX, OR and NX arguments to add to GETs, see set_limit().
+		self.next = {}		# Maps master to the NX cursor it sent, if it left servers out.
+		self.seen = set()	# Addresses already listed, when several masters list the same.
+		self.output = []	# (ip, port, fields) to print, waiting on look-ups to finish.
 		v.callback_set(v.SEND_PING, self._cb_ping)
 
 	def set_master(self, ip):
-		self.master = address_to_ip(ip)
+		self.masters = []
+		self.add_master(ip)
+
+	def add_master(self, ip):
+		"""Add a master server to ask. Lists from all of them are merged."""
+		self.masters.append(address_to_ip(ip))
 
 	def set_duration(self, d):
 		self.duration = d
@@ -45,46 +135,199 @@ class Listener:
 	def set_raw(self, r):
 		self.raw = r
 
-	def set_lookup(self, l):
+	def set_lookup(self, l, path = None):
 		self.lookup = l
+		if l:
+			self.resolver = Resolver(path)
+
+	def set_cache(self, path):
+		"""Keep the server list in the given file between runs, and only ask the masters for
+		   what changed since last time."""
+		self.cache = path
+		self.query = None
+		self.tokens = {}	# Maps master to its last generation token.
+		self.lists = {}		# Maps master to its list, as a map of address to fields.
+		self.building = {}	# Maps master to token of the full list being received.
+		self.parts = {}		# Maps master to (token, packet numbers received, packet count).
+		self.complete = set()	# Masters whose list for the current token is all in.
+		try:
+			f = open(path, "rb")
+			self.query, self.tokens, self.lists = marshal.load(f)
+			f.close()
+		except (IOError, EOFError, ValueError, TypeError):
+			pass
+		if not isinstance(self.tokens, dict) or not isinstance(self.lists, dict):
+			self.query, self.tokens, self.lists = None, {}, {}	# From an older client.
+
+	def set_limit(self, limit = None, fresh = False, after = None):
+		"""Ask for at most limit servers, the most recently seen ones if fresh, or else those
+		   listed after the given address, as printed by an earlier run."""
+		self.limit = ""
+		if limit != None:
+			self.limit += " MX=%u" % limit
+		if fresh:
+			self.limit += " OR=SEEN"
+		if after != None:
+			self.limit += " NX=%s" % after
+
+	def save_cache(self):
+		f = open(self.cache, "wb")
+		marshal.dump((self.query, self.tokens, self.lists), f)
+		f.close()
 
 	def had_enough(self):
-		if self.duration < 0.0: return False
-		return (time.time() - self.created) >= self.duration
+		if self.duration >= 0.0 and (time.time() - self.created) >= self.duration:
+			return True
+		return len(self.done) == len(self.masters)
 
 	def send_get(self, tags = None):
 		cmd = 'MS:GET IP="DE"'
 		if tags != None:
 			cmd += ' TA=%s' % tags
+		cmd += self.limit
+		if self.cache != None and self.query != cmd:	# Cache is for another query, start over.
+			self.query = cmd
+			self.tokens = {}
+			self.lists = {}
+		for m in self.masters:
+			get = cmd
+			if self.cache != None:
+				get += ' GE=%s' % self.tokens.get(m, "0")
+			if not quiet:
+				print "Sending master server GET to", m, ": '%s'" % get
+			v.send_ping(m, get)
+
+	def send_stats(self):
+		for m in self.masters:
+			if not quiet:
+				print "Sending master server STATS request to", m
+			v.send_ping(m, "MS:STATS")
+
+	def _print_server(self, ip, fields):
+		port = ""
+		if ":" in ip:
+			colon = ip.index(":")
+			port = ip[colon:]
+			ip = ip[:colon]
+		if self.lookup:
+			self.resolver.lookup(ip)	# Start it early, printed by poll() when done.
+		self.output.append((ip, port, fields))
+		self.poll()
+
+	def poll(self):
+		"""Print servers in the order listed, as far as their names are known."""
+		n = 0
+		for ip, port, fields in self.output:
+			name = ip
+			if self.lookup:
+				done, name = self.resolver.lookup(ip)
+				if not done:
+					break
+				if name == None:
+					name = ip
+			print " ".join([name + port] + fields)
+			n += 1
+		del self.output[:n]
+
+	def finish(self):
+		"""Print what is left to print, waiting for look-ups if need be."""
+		if self.cache != None:
+			for m in self.masters:
+				if m not in self.complete and self.building.has_key(m):
+					self.tokens.pop(m, None)	# Partial full list, get a full one next time.
+			merged = {}
+			for m in self.masters:
+				for ip, fields in self.lists.get(m, {}).iteritems():
+					merged.setdefault(ip, fields)
+			for ip in sorted(merged.keys()):
+				self._print_server(ip, merged[ip])
+			self.save_cache()
+		while len(self.output) > 0:
+			self.poll()
+			if len(self.output) > 0:
+				time.sleep(0.05)
+		if self.lookup:
+			self.resolver.save()
 		if not quiet:
-			print "Sending master server GET to", self.master, ": '%s'" % cmd
-		v.send_ping(self.master, cmd)
+			for m, cursor in self.next.iteritems():
+				print "More servers at %s, continue with -after=%s" % (m, cursor)
+
+	def _got_server(self, master, ip, fields):
+		if self.cache != None:
+			self.lists.setdefault(master, {})[ip] = fields
+		elif ip not in self.seen:
+			self.seen.add(ip)
+			self._print_server(ip, fields)
+
+	def _got_part(self, master, token, part, last):
+		"""Note a packet of the list with the given token, numbered as in PK=i/n. Returns True
+		   once all n are in. Lists from masters that don't number packets are taken to be all
+		   in when the last one, with EN=1, is."""
+		if part == None:
+			return last
+		try:
+			i, n = [int(x) for x in part.split("/")]
+		except ValueError:
+			return False
+		got = self.parts.get(master)
+		if got == None or got[0] != token:
+			got = self.parts[master] = (token, set(), n)
+		got[1].add(i)
+		return len(got[1]) >= got[2]
+
+	def _master(self, host):
+		for m in self.masters:
+			if host.startswith(m):
+				return m
+		return None
 
 	def _cb_ping(self, host, msg):
 		global time1
-		if host.startswith(self.master):
+		master = self._master(host)
+		if master != None:
 			if time1 == 0: time1 = time.time() - time0
-			if not self.raw:
-				entries = msg[7:].lstrip().split("IP=")
-				for e in entries:
-					if len(e) == 0: continue
-					if self.lookup and " " in e:
-						ss = e.index(" ")
-						ip = e[:ss]
-						ip.strip('"').strip()
-						port = ""
-						if ":" in ip:
-							colon = ip.index(":")
-							port = ip[colon + 1:]
-							ip = ip[:colon:]
-						try:	out = socket.gethostbyaddr(ip)[0]
-						except:	out = ip
-						if port != "":	print "%s:%s" % (out, port),
-						else:		print out,
-						e = e[ss + 1:]
-					print e
-			else:
+			if msg.startswith("MS:STATS"):
+				print msg[9:]
+				return
+			if self.raw:
 				print msg
+			try:
+				pairs = msparse.parse_pairs(msg[7:])
+			except msparse.ParseError, e:
+				print "Ignoring malformed list from master:", e
+				return
+			ip = None
+			token = None
+			last = False
+			part = None
+			for key, value in pairs + (("IP", None),):
+				if key in ("IP", "RM") and ip != None:
+					if not self.raw:
+						self._got_server(master, ip, fields)
+					ip = None
+				if key == "IP":
+					ip = value
+					fields = []
+				elif key == "RM":
+					if self.cache != None:
+						self.lists.get(master, {}).pop(value, None)
+				elif key == "GE":
+					token = value
+				elif key == "PK":
+					part = value
+				elif key == "NX":
+					self.next[master] = value
+				elif key == "FU" and self.cache != None and token != self.building.get(master):
+					self.lists[master] = {}		# A full list, not changes. Start over.
+					self.building[master] = token
+				elif key == "EN" and ip == None:
+					self.done.add(master)
+					last = True
+				elif ip != None:
+					fields += ['%s="%s"' % (key, msparse.quote(value))]
+			if token != None and self.cache != None and self._got_part(master, token, part, last):
+				self.tokens[master] = token	# Only once the whole list is in, else changes would be missed.
+				self.complete.add(master)
 		else:
 			print "Ping from unknown host at", host, ":", msg
 
@@ -92,10 +335,17 @@ def usage():
 	print "Verse Master Server test client. Written 2006 by Emil Brink."
 	print "Usage:"
 	print " -duration=TIME\t\tRun for at most TIME seconds. Set to negative to disable."
+	print "\t\t\tStops earlier once all masters have sent their whole lists."
+	print " -cache=FILE\t\tKeep list in FILE, and only fetch changes. Printed at exit."
 	print " -h\t\t\tShow this usage information, and exit."
-	print " -ip=IP[:PORT]\t\tSet the address for the master server."
+	print " -after=IP[:PORT]\tList only servers after this one, as printed when more are left."
+	print " -fresh\t\t\tList the most recently seen servers first."
+	print " -ip=IP[:PORT]\t\tSet the address for the master server. Repeat to ask several."
+	print " -max=N\t\t\tList at most N servers."
 	print " -n\t\t\tShow listed Verse servers by name, through a reverse look-up."
+	print " -names=FILE\t\tKeep looked-up names in FILE. Default is %s." % NAME_CACHE
 	print " -raw\t\t\tDisable interpretation of MS:LIST commands; show them as they are."
+	print " -stats\t\t\tAsk for the master server's statistics, rather than a list."
 	print " -tags=TAGS\t\tSet tag filter to use. Example: -tags=open,sweden,-r6p0."
 	print " -q\t\t\tBe quiet, only print actual list of responses"
 
@@ -109,8 +359,12 @@ def main(arg = None):
 
 	mode = 'get'
 	tags = None
-
-	listen.set_master("master.uni-verse.org:4950")
+	masters = []
+	lookup = False
+	limit = None
+	fresh = False
+	after = None
+	names = os.path.expanduser(NAME_CACHE)
 
 	for a in arg[1:]:
 		if a.startswith("-duration="):
@@ -118,15 +372,27 @@ def main(arg = None):
 				d = float(a[10:])
 				listen.set_duration(d)
 			except:	pass
+		elif a.startswith("-cache="):
+			listen.set_cache(a[7:])
+		elif a.startswith("-after="):
+			after = a[7:]
+		elif a == "-fresh":
+			fresh = True
+		elif a.startswith("-max="):
+			limit = int(a[5:])
 		elif a.startswith("-ip="):
-			listen.set_master(a[4:])
+			masters.append(a[4:])
 		elif a == "-h":
 			usage()
 			sys.exit()
 		elif a == "-n":
-			listen.set_lookup(True)
+			lookup = True
+		elif a.startswith("-names="):
+			names = a[7:]
 		elif a == "-raw":
 			listen.set_raw(True)
+		elif a == "-stats":
+			mode = 'stats'
 		elif a.startswith("-tags="):
 	    		tags = a[6:]
 		elif a == "-q":
@@ -134,14 +400,27 @@ def main(arg = None):
 		elif a[0] == '-':
 			print "Unknown option", a
 
+	if len(masters) == 0:
+		masters = ["master.uni-verse.org:4950"]
+	listen.set_master(masters[0])
+	for m in masters[1:]:
+		listen.add_master(m)
+	listen.set_lookup(lookup, names)
+	listen.set_limit(limit, fresh, after)
+
 	if mode == 'get':
 		listen.send_get(tags)
-		time0 = time.time()
+	elif mode == 'stats':
+		listen.send_stats()
+	time0 = time.time()
 
 	while 1:
 		v.callback_update(50000)
+		listen.poll()
 		if listen.had_enough(): break
 
+	listen.finish()
+
 	if not quiet and time1 > 0:
 		print "Got first response after %.2f seconds" % time1
 
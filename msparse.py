@@ -0,0 +1,104 @@
+#
+# Parsing and quoting of Verse master server commands, shared by the master server and
+# the test client. A command is a sequence of KEY=value pairs, where KEY is upper-case
+# and value is either a run of non-space characters, or a double-quoted string in which
+# backslash escapes the next character.
+#
+
+import re
+
+from collections import OrderedDict
+
+CACHE_SIZE = 256	# Number of distinct command strings whose parse results are remembered.
+
+_PAIR = re.compile(r'\s*([A-Z]+)(?:=(?:"((?:[^"\\]|\\.)*)"|([^\s"\\]*)))?', re.DOTALL)
+_SPACE = re.compile(r'\s*')
+_ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+_QUOTE = re.compile(r'(["\\])')
+
+class ParseError(Exception):
+	"""Raised when a command can't be parsed. Knows where, and why."""
+	def __init__(self, reason, cmd, pos):
+		Exception.__init__(self, "%s, at offset %u of \"%s\"" % (reason, pos, cmd))
+		self.reason = reason
+		self.cmd = cmd
+		self.pos = pos
+
+def quote(s):
+	"""Quote a string to comply with the Master server protocol's quoting rules."""
+	return _QUOTE.sub(r'\\\1', s)
+
+def unquote(s):
+	"""Undo quote()."""
+	return _ESCAPE.sub(r'\1', s)
+
+def _parse_pairs(cmd):
+	pairs = []
+	i = 0
+	l = len(cmd)
+	while 1:
+		i = _SPACE.match(cmd, i).end()
+		if i >= l:
+			return pairs
+		m = _PAIR.match(cmd, i)
+		if m == None:
+			raise ParseError("Expected upper-case key name", cmd, i)
+		key, quoted, plain = m.groups()
+		if m.end(1) >= l or cmd[m.end(1)] != '=':
+			raise ParseError("Keyword '%s' not followed by equals sign" % key, cmd, m.end(1))
+		i = m.end()
+		if quoted != None:
+			pairs.append((key, unquote(quoted)))
+			continue
+		if i == m.end(1) + 1 and i < l and cmd[i] == '"':
+			raise ParseError("Missing final quote", cmd, i)
+		if i < l and cmd[i] in '"\\':
+			raise ParseError("No quotes or backslashes in unquoted strings please", cmd, i)
+		pairs.append((key, plain))
+
+class Cache:
+	"""A bounded least-recently-used map, here from command string to parse result. The master
+	   server uses it for other things too. If given, evicted is called with the key and value
+	   of each item pushed out to make room. Values can't be None."""
+	def __init__(self, size = CACHE_SIZE, evicted = None):
+		self.size = size
+		self.evicted = evicted
+		self.items = OrderedDict()
+
+	def __len__(self):
+		return len(self.items)
+
+	def get(self, key):
+		r = self.items.pop(key, None)
+		if r != None:
+			self.items[key] = r	# Re-insert, making it most recently used.
+		return r
+
+	def put(self, key, r):
+		if self.items.pop(key, None) == None and len(self.items) >= self.size:
+			old = self.items.popitem(last = False)
+			if self.evicted != None:
+				self.evicted(*old)
+		self.items[key] = r
+
+_cache = Cache()
+
+def parse_pairs(cmd):
+	"""Parse a command into a tuple of (key, value) pairs, in order. Keys can repeat, as in
+	   MS:LIST. Raises ParseError on malformed input. Results are cached, since most commands
+	   are sent many times over."""
+	r = _cache.get(cmd)
+	if r == None:
+		try:
+			r = tuple(_parse_pairs(cmd))
+		except ParseError, e:
+			r = e
+		_cache.put(cmd, r)
+	if isinstance(r, ParseError):
+		raise r
+	return r
+
+def parse(cmd):
+	"""Parse a command into a dictionary of keyword=value pairs. If a key repeats, the last
+	   value wins. Raises ParseError on malformed input."""
+	return dict(parse_pairs(cmd))
@@ -8,47 +8,70 @@
 #
 # ./client.py -q -duration=2 -n | ./pagebuilder.py >test.html
 #
+# Given an output directory, the page is instead kept there along with a JSON version
+# of the list, and both are only re-rendered when the set of servers has changed. The
+# same directory can then be served over HTTP, pre-compressed and with ETags:
+#
+# ./client.py -q -duration=2 -n | ./pagebuilder.py -o /var/cache/verse-page
+# ./pagebuilder.py -o /var/cache/verse-page -s 8080
+#
 # Written by Emil Brink, PDC KTH in 2007. Released as public domain.
 #
 
+import BaseHTTPServer
+import SocketServer
+import getopt
+import gzip
+import hashlib
+import json
+import marshal
+import os
+import re
 import sys
 import time
 
+from cStringIO import StringIO
+
+PAGES = "pages.dat"	# File in output directory holding the rendered pages, for the HTTP server.
+MAX_AGE = 60		# Seconds clients may cache a page without asking again.
+
+_TOKEN = re.compile(r'(?:[^\s"]|"(?:[^"\\]|\\.)*")+')
+_QUOTED = re.compile(r'"((?:[^"\\]|\\.)*)"')
+_ESCAPE = re.compile(r'\\(.)')
+
 def tokenize(s):
-	tokens = []
-	quote = False
-	token = ""
-	for c in s:
-		if c == " " and not quote:	# Spaces separate tokens.
-			if len(token) > 0:
-				tokens += [token]
-				token = ""
-		elif c == '"':
-			if quote:
-				quote = False
-			else:
-				quote = True
-		else:
-			token += c
-	if token != "" and not quote:
-		tokens += [token]
-	return tokens
+	"""Split a line of client.py output into tokens at spaces. Quotes are removed, and backslash-
+	   escaped characters within them are unescaped."""
+	return [_QUOTED.sub(lambda m: _ESCAPE.sub(r'\1', m.group(1)), t) for t in _TOKEN.findall(s)]
 
 def escape(s):
-	es = ""
-	for c in s:
-		if c == '"':	es += "&quot;"
-		elif c == '<':	es += "&lt;"
-		elif c == '&':	es += "&amp;"
-		else:		es += c
-	return s
+	"""Escape a string for inclusion in HTML text or attribute values."""
+	return s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
 
-servers = []
+def read_servers(f):
+	"""Read client.py output, returning a list of (address, fields) tuples, where fields is a
+	   dictionary of the KEY=value pairs given for the server."""
+	servers = []
+	for line in f:
+		tok = tokenize(line.strip())
+		if len(tok) == 0:
+			continue
+		fields = {}
+		for t in tok[1:]:
+			key, eq, value = t.partition("=")
+			if eq:
+				fields[key] = value
+		servers.append((tok[0], fields))
+	return servers
 
-for line in sys.stdin:
-	servers += [line.strip()]
+def content_hash(servers):
+	"""Return a hash of the server list, which changes only if the list does."""
+	h = hashlib.sha1()
+	for address, fields in servers:
+		h.update(repr((address, sorted(fields.items()))))
+	return h.hexdigest()
 
-print """<!doctype HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">
+HEAD = """<!doctype HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" "http://www.w3.org/TR/html4/strict.dtd">
 <html>
 <head>
  <meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1"/>
@@ -80,40 +103,17 @@ run your own server locally (perhaps on your own desktop PC) is
 <a href="http://www.uni-verse.org/">openly available</a>, and it does not require much from
 your computer.
 </p>
-"""
 
-print """<table align="center" width="80%" cellpadding="4" cellspacing="0">
+<table align="center" width="80%" cellpadding="4" cellspacing="0">
 <tr>
  <th align="center" width="10%">Index</th>
  <th align="left" width="35%">Server Address</th>
  <th align="left">Description</th>
 </tr>
-"""
-
-i = 0
-for s in servers:
-	tok = tokenize(s)
-	print "<tr class=\"%s\"><td align=\"right\">%u</td><td><tt><a href=\"verse://%s\">%s</a></tt></td>" % (["even", "odd"][i & 1], i, tok[0], tok[0])
-	de = ""
-	if len(tok) > 1:
-		for t in tok[1:]:
-			if t.startswith("DE="):
-				de = escape(t[3:])
-	print "<td>%s</td>" % de
-	print "</tr>"
 
-	i += 1
-
-print "</table>"
-
-extra = ""
-if i == 0:
-	extra = "Perhaps the master server itself is down? Not good ..."
-print "<p><b>%u</b> servers available, total. %s" % (i, extra)
-
-print "<p>The above list was generated at %s (UTC), by quering the Verse master server at <tt>master.uni-verse.org</tt>.</p>" % time.strftime("%Y-%m-%d, %H:%M:%S", time.gmtime())
+"""
 
-print """
+FOOT = """
 <p>
 Verse is not a standardized URI protocol, understood by web browsers. The server column above still contains
 links with a verse: protocol type, since it might be useful to some. If clicking these addresses cannot be
@@ -133,4 +133,179 @@ Some links that might be of interest:
 <div class="foot"><a href="http://projects.blender.org/viewcvs/viewcvs.cgi/verse-master/pagebuilder.py?rev=HEAD&cvsroot=verse&content-type=text/vnd.viewcvs-markup">Pagebuilder</a> by Emil Brink</div>
 </body>
 </html>
+
 """
+
+def render_html(servers, generated):
+	out = [HEAD]
+	i = 0
+	for address, fields in servers:
+		a = escape(address)
+		out.append("<tr class=\"%s\"><td align=\"right\">%u</td><td><tt><a href=\"verse://%s\">%s</a></tt></td>\n" % (["even", "odd"][i & 1], i, a, a))
+		out.append("<td>%s</td>\n" % escape(fields.get("DE", "")))
+		out.append("</tr>\n")
+		i += 1
+	out.append("</table>\n")
+
+	extra = ""
+	if i == 0:
+		extra = "Perhaps the master server itself is down? Not good ..."
+	out.append("<p><b>%u</b> servers available, total. %s\n" % (i, extra))
+	out.append("<p>The above list was generated at %s (UTC), by quering the Verse master server at <tt>master.uni-verse.org</tt>.</p>\n" % time.strftime("%Y-%m-%d, %H:%M:%S", time.gmtime(generated)))
+	out.append(FOOT)
+	return "".join(out)
+
+def render_json(servers, generated):
+	doc = { "generated": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(generated)),
+		"servers": [dict(fields, address = address) for address, fields in servers] }
+	return json.dumps(doc, indent = 1, sort_keys = True, encoding = "iso-8859-1") + "\n"
+
+def compress(data, mtime):
+	"""Gzip data. The header time is given, so equal data compresses to equal bytes."""
+	buf = StringIO()
+	f = gzip.GzipFile(fileobj = buf, mode = "wb", compresslevel = 9, mtime = mtime)
+	f.write(data)
+	f.close()
+	return buf.getvalue()
+
+def write_file(path, data):
+	"""Write a file under a temporary name, then rename it into place, so readers never see
+	   a partial one."""
+	tmp = path + ".tmp"
+	f = open(tmp, "wb")
+	f.write(data)
+	f.close()
+	os.rename(tmp, path)
+
+def load_pages(path):
+	"""Load rendered pages, as (hash, { name: (content type, body, gzipped body) })."""
+	f = open(path, "rb")
+	try:
+		return marshal.load(f)
+	finally:
+		f.close()
+
+def build(servers, directory):
+	"""Render the server list into the given directory, unless it's unchanged since last time.
+	   Returns True if anything was rendered."""
+	h = content_hash(servers)
+	path = os.path.join(directory, PAGES)
+	try:
+		if load_pages(path)[0] == h:
+			return False
+	except (IOError, EOFError, ValueError, TypeError):
+		pass
+	now = int(time.time())
+	pages = {}
+	for name, ctype, body in [("index.html", "text/html; charset=iso-8859-1", render_html(servers, now)),
+				  ("servers.json", "application/json", render_json(servers, now))]:
+		gz = compress(body, now)
+		write_file(os.path.join(directory, name), body)
+		write_file(os.path.join(directory, name + ".gz"), gz)
+		pages[name] = (ctype, body, gz)
+	write_file(path, marshal.dumps((h, pages)))
+	return True
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Serves the pages rendered by build(). Nothing is rendered here; the bodies are sent as
+	   they are, gzipped if the client accepts that, and with the content hash as ETag."""
+	server_version = "pagebuilder"
+	names = { "/": "index.html", "/index.html": "index.html", "/servers.json": "servers.json" }
+
+	def do_GET(self):
+		self.reply(True)
+
+	def do_HEAD(self):
+		self.reply(False)
+
+	def reply(self, body):
+		h, pages = self.server.current()
+		name = self.names.get(self.path.partition("?")[0])
+		if name == None or not pages.has_key(name):
+			self.send_error(404)
+			return
+		ctype, data, gz = pages[name]
+		zipped = "gzip" in self.headers.get("Accept-Encoding", "")
+		etag = '"%s%s"' % (h, ["", "-gz"][zipped])	# Each encoding is its own entity.
+		if etag in [t.strip() for t in self.headers.get("If-None-Match", "").split(",")]:
+			self.send_response(304)
+			self.send_header("ETag", etag)
+			self.end_headers()
+			return
+		self.send_response(200)
+		if zipped:
+			data = gz
+			self.send_header("Content-Encoding", "gzip")
+		self.send_header("Content-Type", ctype)
+		self.send_header("Content-Length", str(len(data)))
+		self.send_header("ETag", etag)
+		self.send_header("Vary", "Accept-Encoding")
+		self.send_header("Cache-Control", "max-age=%u" % MAX_AGE)
+		self.end_headers()
+		if body:
+			self.wfile.write(data)
+
+	def log_message(self, format, *args):
+		pass		# One line per hit is too much under real traffic.
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	"""HTTP server for a build() directory. The pages are reloaded when the file changes."""
+	daemon_threads = True
+
+	def __init__(self, port, directory):
+		BaseHTTPServer.HTTPServer.__init__(self, ("", port), Handler)
+		self.path = os.path.join(directory, PAGES)
+		self.stamp = None
+		self.pages = ("", {})
+
+	def current(self):
+		try:
+			st = os.stat(self.path)
+			stamp = (st.st_mtime, st.st_ino)
+			if stamp != self.stamp:
+				self.pages = load_pages(self.path)
+				self.stamp = stamp
+		except (OSError, IOError, EOFError, ValueError, TypeError):
+			pass		# Keep serving what we have.
+		return self.pages
+
+
+def usage():
+	print "Verse server list page builder. Usage: pagebuilder.py [options] <client-output"
+	print "Options:"
+	print " -h or --help\t\t\tThis text."
+	print " -o DIR or --output=DIR\t\tKeep HTML and JSON pages in DIR, re-rendered only on change."
+	print " -s PORT or --serve=PORT\tServe pages in DIR over HTTP on PORT, instead of reading input."
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "ho:s:", ["help", "output=", "serve="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	directory = None
+	port = None
+	for o, a in opts:
+		if o in ["-h", "--help"]:
+			usage()
+			sys.exit()
+		elif o in ["-o", "--output"]:
+			directory = a
+		elif o in ["-s", "--serve"]:
+			port = int(a)
+
+	if port != None:
+		if directory == None:
+			usage()
+			sys.exit(2)
+		Server(port, directory).serve_forever()
+	servers = read_servers(sys.stdin)
+	if directory == None:
+		sys.stdout.write(render_html(servers, time.time()))
+	else:
+		build(servers, directory)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# Replays pings recorded by a master server run with --capture into a master server Database,
+# running in-process on top of a fake transport, as in benchmark.py. The capture can be fed
+# at the pace it was recorded, N times faster, or as fast as possible. However fast, the master
+# sees the time of each ping as recorded, so expiry and retries happen as they did live.
+# Reports throughput and latency per message type, and, given a second master script, replays
+# the same capture into that too and checks that both end up with the same registered servers
+# and send the same lists. No Verse servers or clients are needed.
+#
+# A suitable command-line might be:
+#
+# ./replay.py -b old-verse-master.py -o new.json traffic.cap
+#
+
+import getopt
+import hashlib
+import json
+import sys
+import time
+
+import benchmark
+import msparse
+
+# Message types, by prefix, as reported. Everything else is OTHER.
+KINDS = [("MS:ANNOUNCE", "ANNOUNCE"), ("MS:GET", "GET"), ("DESCRIPTION ", "DESCRIPTION")]
+
+MAX_DIFFS = 10		# Number of differences between runs shown, at the most.
+
+def list_entries(message):
+	"""Return the servers listed in an MS:LIST packet, as one string per IP or RM. Generation
+	   tokens, flags and packet numbers are left out, since they differ between runs even when
+	   the lists don't."""
+	try:
+		pairs = msparse.parse_pairs(message[7:])
+	except msparse.ParseError:
+		return ["?" + message]
+	entries = []
+	for key, value in pairs:
+		if key in ("IP", "RM"):
+			entries.append([key + "=" + value])
+		elif key not in ("GE", "FU", "EN", "PK") and len(entries) > 0:
+			entries[-1].append('%s="%s"' % (key, msparse.quote(value)))
+	return [" ".join(e) for e in entries]
+
+class RecordingTransport(benchmark.FakeTransport):
+	"""A fake transport that also keeps what was listed in MS:LIST packets, until taken."""
+	def __init__(self):
+		benchmark.FakeTransport.__init__(self)
+		self.entries = []
+
+	def send(self, address, message):
+		benchmark.FakeTransport.send(self, address, message)
+		if message.startswith("MS:LIST"):
+			self.entries.extend(list_entries(message))
+
+	def take(self):
+		"""Return the entries listed since last time, in a canonical order."""
+		e = sorted(self.entries)
+		self.entries = []
+		return e
+
+class Clock:
+	"""Stands in for the time module of the master under replay, which then runs on the time
+	   set here, rather than on the wall clock."""
+	def __init__(self, now):
+		self.now = now
+
+	def time(self):
+		return self.now
+
+	def __getattr__(self, name):
+		return getattr(time, name)
+
+def kind_of(message):
+	for prefix, kind in KINDS:
+		if message.startswith(prefix):
+			return kind
+	return "OTHER"
+
+def replay(master, records, speed):
+	"""Replay records into the master script at the given path, and return a dictionary of results.
+	   Speed is how many times faster than recorded to go, or zero for as fast as possible."""
+	vm = benchmark.load_master(master)
+	vm.LIST_PERIOD = 0.0		# Don't pace lists, we drain them after each GET.
+	clock = Clock(records[0][0])
+	vm.time = clock
+	transport = RecordingTransport()
+	db = vm.Database(vm.VERSE_PORT, vm.LOG_ERROR, transport)
+	db.set_list_rate(1e12)
+	db.set_describe_rate(1e12)
+	db.set_limits(None)		# Replayed faster, pings would be rejected that weren't.
+	rec = benchmark.Recorder(transport)
+	gets = []			# (address, servers listed, digest of list) for each GET.
+
+	t0 = time.time()
+	for t, address, message in records:
+		if speed > 0.0:
+			delay = t0 + (t - records[0][0]) / speed - time.time()
+			if delay > 0.0:
+				time.sleep(delay)
+		clock.now = t
+		db.flush()
+		db.clean()
+		kind = kind_of(message)
+		rec.run(kind, address, message)
+		if kind == "GET":
+			p, b = transport.packets, transport.bytes
+			t1 = time.time()
+			while db.listjobs.next_deadline() != None:
+				db.flush()
+			rec.add("LIST", time.time() - t1, p, b)
+			entries = transport.take()
+			gets.append((address, len(entries), hashlib.sha1("\n".join(entries)).hexdigest()))
+	wall = time.time() - t0
+
+	return {
+		"master": master,
+		"speed": speed,
+		"pings": len(records),
+		"wall_seconds": wall,
+		"pings_per_second": len(records) / max(wall, 1e-9),
+		"packets_sent": transport.packets,
+		"bytes_sent": transport.bytes,
+		"messages": rec.report(),
+		"registered": sorted([e.address() for e in db.servers.itervalues()]),
+		"gets": gets,
+	}
+
+def compare(result, baseline):
+	"""Return a list of differences in responses between two replays of the same capture."""
+	diffs = []
+	ours, theirs = set(result["registered"]), set(baseline["registered"])
+	if ours != theirs:
+		diffs.append("registered: %u servers vs %u; only in first: %s; only in second: %s" % (len(ours), len(theirs),
+			" ".join(sorted(ours - theirs)[:3]) or "-", " ".join(sorted(theirs - ours)[:3]) or "-"))
+	if len(result["gets"]) != len(baseline["gets"]):
+		diffs.append("%u GETs answered vs %u" % (len(result["gets"]), len(baseline["gets"])))
+	for i, (a, b) in enumerate(zip(result["gets"], baseline["gets"])):
+		if a[2] != b[2]:
+			diffs.append("GET %u from %s: %u servers listed vs %u, contents differ" % (i, a[0], a[1], b[1]))
+	return diffs
+
+def summarize(result, baseline = None):
+	"""Print a human-readable summary of a replay, compared to a baseline replay if given."""
+	print >>sys.stderr, "%s: %u pings in %.2f s, %.0f pings/s, %u registered, %u GETs, %u packets" % (result["master"],
+		result["pings"], result["wall_seconds"], result["pings_per_second"], len(result["registered"]),
+		len(result["gets"]), result["packets_sent"])
+	benchmark.summarize_messages(result["messages"], baseline)
+
+def usage():
+	print "Verse Master Server capture replay. Usage: replay.py [options] CAPTURE"
+	print "Options:"
+	print " -h or --help\t\t\tThis text."
+	print " -m FILE or --master=FILE\tReplay into this master script. Default is %s." % benchmark.MASTER
+	print " -b FILE or --baseline=FILE\tAlso replay into this master script, and compare responses."
+	print " -s N or --speed=N\t\tReplay N times faster than recorded. 0, the default, is as fast as possible."
+	print " -o FILE or --output=FILE\tWrite JSON results to FILE, rather than stdout."
+
+def main():
+	try:
+		opts, args = getopt.getopt(sys.argv[1:], "hm:b:s:o:", ["help", "master=", "baseline=", "speed=", "output="])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+	master = benchmark.MASTER
+	baseline = None
+	speed = 0.0
+	output = None
+	for o, a in opts:
+		if o in ["-h", "--help"]:
+			usage()
+			sys.exit()
+		elif o in ["-m", "--master"]:
+			master = a
+		elif o in ["-b", "--baseline"]:
+			baseline = a
+		elif o in ["-s", "--speed"]:
+			speed = float(a)
+		elif o in ["-o", "--output"]:
+			output = a
+	if len(args) != 1:
+		usage()
+		sys.exit(2)
+
+	try:
+		records = list(benchmark.load_master(master).read_capture(args[0]))
+	except (IOError, ValueError), e:
+		print >>sys.stderr, "Can't read capture:", e
+		sys.exit(2)
+	if len(records) == 0:
+		print >>sys.stderr, "Capture %s is empty" % args[0]
+		sys.exit(2)
+
+	result = benchmark.isolated(replay, master, records, speed)
+	doc = { "capture": args[0], "results": [result] }
+	diffs = []
+	if baseline != None:
+		base = benchmark.isolated(replay, baseline, records, speed)
+		summarize(base)
+		summarize(result, base)
+		doc["results"].append(base)
+		diffs = compare(result, base)
+		for d in diffs[:MAX_DIFFS]:
+			print >>sys.stderr, "  differs:", d
+		if len(diffs) > MAX_DIFFS:
+			print >>sys.stderr, "  ... and %u more differences" % (len(diffs) - MAX_DIFFS)
+		if len(diffs) == 0:
+			print >>sys.stderr, "  same responses"
+	else:
+		summarize(result)
+
+	if output != None:
+		f = open(output, "w")
+		json.dump(doc, f, indent = 1, sort_keys = True)
+		f.close()
+	else:
+		json.dump(doc, sys.stdout, indent = 1, sort_keys = True)
+		print
+	if len(diffs) > 0:
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
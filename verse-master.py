@@ -4,20 +4,75 @@
 # to interested clients upon request. The list entries time out if not refreshed.
 #
 
+import bisect
+import collections
 import getopt
+import heapq
+import marshal
+import os
+import errno
+import random
+import select
+import signal
 import socket
+import struct
 import sys
+import threading
 import time
 
-import verse as v
+try:
+	import verse as v
+except ImportError:
+	v = None	# Only the socket transport is available, then.
+
+import msparse
 
 VERSION     = "0.5"
 VERSE_PORT  = 4950
 
 QUEUE_SIZE  = 512	# Number of outstanding DESCRIBE servers we have, at the most.
+DESCRIBE_RATE = 100.0	# Global budget for outgoing DESCRIBE requests, per second.
+DESCRIBE_RETRY = 2.0	# Time before the first DESCRIBE is repeated; doubles for each try.
+DESCRIBE_TRIES = 4	# Number of DESCRIBEs sent to a server before giving up on it.
+PENDING_TIMEOUT = 30.0	# Max time a server can stay queued without answering a DESCRIBE.
 MAX_PER_IP  = 4		# Maximum number of servers allowed per IP address.
 SERVER_TIMEOUT = 137.0	# Max time, in seconds, between ANNOUNCEs, or server is kicked.
 LIST_PERIOD = 0.5	# Period between successive list packets to a single client.
+LIST_RATE   = 200.0	# Global budget for outgoing MS:LIST packets, per second.
+MAX_JOBS_PER_IP = 2	# Maximum number of lists being sent to a single IP at once.
+PACKET_MTU  = 1500	# Max size of datagrams sent, including all headers.
+PACKET_OVERHEAD = 110	# Bytes of each datagram taken by IP, UDP and Verse headers.
+DESCRIPTION_MAX = 256	# Max length of a server description; longer ones are cut.
+LIST_HEADER_ROOM = 64	# Bytes of a list packet kept for MS:LIST and its GE=, FU=, NX=, EN= and PK=.
+FRAGMENT_MAX = len(' IP=255.255.255.255:65535 DE=""') + 2 * DESCRIPTION_MAX	# Longest list entry, all quoted.
+MTU_MIN = PACKET_OVERHEAD + LIST_HEADER_ROOM + FRAGMENT_MAX	# Smallest MTU that fits any entry.
+LIST_CACHE_SIZE = 64	# Max number of distinct GET queries whose packet lists are kept.
+CHANGELOG_SIZE = 4096	# Number of recent registry changes kept, for answering delta GETs.
+ORDER_REFRESH = 5.0	# Max age of a cached list ordered by time seen, in seconds.
+SNAPSHOT_PERIOD = 30.0	# Time between registry snapshots, if enabled.
+SNAPSHOT_MAGIC = "verse-master-snapshot-2"
+CAPTURE_MAGIC = "verse-master-capture-1"
+SYNC_DELAY  = 1.0	# Max time before new or removed servers are sent to peer masters.
+SYNC_PERIOD = 30.0	# Period between refreshes of touched servers to peer masters.
+RESYNC_HOLDOFF = 10.0	# Min time between requests for a full resync from one peer.
+CHANNEL_FRAME_OPS = 1000	# Max number of operations sent to or from a worker in one frame.
+LIMITER_SIZE = 16384	# Max number of per-IP and per-subnet token buckets kept.
+LOG_BACKLOG = 10000	# Max number of log lines waiting to be written; more are dropped.
+LOG_BURST   = 10	# Max number of similar log messages per second; more are summed up.
+CAPTURE_FLUSH = 1.0	# Max time captured pings are buffered before being written out.
+VERSE_WAIT_MAX = 1.0	# Max time the verse transport waits for pings, so signals get handled.
+PROFILE_INTERVAL = 0.005	# CPU time between stack samples, while the loop profiler is on.
+PROFILE_DEPTH = 32	# Max number of frames kept per sampled stack.
+PROFILE_TOP = 40	# Number of most common stacks written in a profile.
+
+LOG_ERROR, LOG_INFO, LOG_DEBUG = range(3)	# Log levels, from terse to chatty.
+
+# Admission budgets per kind of incoming ping, as (rate, burst) for a single IP and for a /24.
+LIMITS = {
+	"announce":	((4.0, 16.0),	(32.0, 128.0)),
+	"description":	((4.0, 16.0),	(32.0, 128.0)),
+	"get":		((1.0, 5.0),	(10.0, 30.0)),
+}
 
 def strip_ip(ip):
 	"""Strips an IP:port address into just the IP, which is returned as a string."""
@@ -27,9 +82,84 @@ def strip_ip(ip):
 		return ip[:colon]
 	return ip
 
+IPV4 = struct.Struct("!I")
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", [0x200, 15][sys.platform.startswith("linux")])	# Not in Python 2.
+
+def pack_address(address):
+	"""Packs an IP[:port] address into an integer, (IPv4 << 16) | port. Returns None if it's not
+	   a valid dotted-decimal IPv4 address."""
+	ip, colon, port = address.partition(":")
+	try:
+		if colon:
+			port = int(port)
+			if port < 0 or port > 65535:
+				return None
+		else:
+			port = VERSE_PORT
+		return (IPV4.unpack(socket.inet_aton(ip))[0] << 16) | port
+	except (ValueError, socket.error):
+		return None
+
+def unpack_address(key):
+	"""Unpacks an address packed by pack_address() into an IP:port string."""
+	return "%s:%u" % (socket.inet_ntoa(IPV4.pack(key >> 16)), key & 0xffff)
+
+def list_address(key):
+	"""Formats a packed address as in MS:LIST packets, where the standard port is left out."""
+	ip = socket.inet_ntoa(IPV4.pack(key >> 16))
+	if key & 0xffff != VERSE_PORT:
+		return "%s:%u" % (ip, key & 0xffff)
+	return ip
+
+def pack_fragments(fragments, room):
+	"""Pack string fragments into as few bins as possible, where each bin holds at most room
+	   bytes. Best-fit decreasing: the longest fragments are placed first, each into the fullest
+	   bin that still has room for it. Returns (bins, dropped), where bins is a list of lists of
+	   fragments, and dropped is the number of fragments too long to fit even an empty bin."""
+	bins = []
+	free = []		# Sorted list of (bytes left, bin index), for bins not yet full.
+	dropped = 0
+	order = sorted(fragments, key = len, reverse = True)
+	if len(order) == 0:
+		return bins, dropped
+	smallest = len(order[-1])
+	for f in order:
+		n = len(f)
+		if n > room:
+			dropped += 1
+			continue
+		i = bisect.bisect_left(free, (n, -1))
+		if i < len(free):
+			left, b = free.pop(i)
+			bins[b].append(f)
+		else:
+			left, b = room, len(bins)
+			bins.append([f])
+		if left - n >= smallest:	# Else it's full for good, no need to look at it again.
+			bisect.insort(free, (left - n, b))
+	return bins, dropped
+
+def pack_in_order(fragments, room):
+	"""Pack string fragments into bins of at most room bytes, keeping their order: each bin is
+	   filled up before the next is started. Returns (bins, dropped), as pack_fragments()."""
+	bins = []
+	left = 0
+	dropped = 0
+	for f in fragments:
+		n = len(f)
+		if n > room:
+			dropped += 1
+			continue
+		if len(bins) == 0 or n > left:
+			bins.append([])
+			left = room
+		bins[-1].append(f)
+		left -= n
+	return bins, dropped
+
 def is_tag(string):
 	"""Validate a string as being a valid tag name."""
-	if string[0].islower():
+	if len(string) > 0 and string[0].islower():
 		for x in string[1:]:
 			if not (x.islower() or x.isdigit() or x == '_'):
 				return False
@@ -37,180 +167,1051 @@ def is_tag(string):
 	return False
 
 class QueueEntry:
-	def __init__(self, ip = None):
-		self.ip = None
-		self.justip = strip_ip(self.ip)
-		self.time = None
-
-	def update(self, ip):
+	def __init__(self, ip, now):
 		self.ip = ip
 		self.justip = strip_ip(ip)
-		self.time = time.time()
-		v.send_ping(ip, "DESCRIBE DE,TA")	# Ask the server to describe itself to us.
+		self.time = now		# When the first ANNOUNCE was heard.
+		self.due = now		# When the next DESCRIBE should be sent.
+		self.tries = 0		# Number of DESCRIBEs sent so far.
 
-	def clear(self):
-		self.ip = None
-		self.justip = None
+	def update(self, now, transport):
+		"""Ask the server to describe itself to us, and schedule the next try with a doubled delay."""
+		transport.send(self.ip, "DESCRIBE DE,TA")
+		self.due = now + DESCRIBE_RETRY * (1 << self.tries)
+		self.tries += 1
 
-	def is_valid(self):
-		return self.ip != None
+	def is_stale(self, now):
+		return self.tries >= DESCRIBE_TRIES or now - self.time >= PENDING_TIMEOUT
 
-	def has_ip(self, ip):
-		return self.justip == ip
 
-	def has_address(self, ip):
-		return self.ip == ip
+class Queue:
+	"""Table of servers that have announced themselves, but not yet answered a DESCRIBE. The
+	   DESCRIBEs are sent from a heap of (due, seq, entry), paced by a token bucket, and repeated
+	   with exponential backoff until the server answers, or gives up by going stale. When the
+	   table is full, new servers are turned away rather than pushing out pending ones."""
+	def __init__(self, transport, stats, size = QUEUE_SIZE, rate = DESCRIBE_RATE):
+		self.transport = transport
+		self.stats = stats
+		self.size = size
+		self.rate = rate
+		self.burst = max(1.0, rate)	# Room for at least one, or rates below 1/s would never send.
+		self.tokens = self.burst
+		self.refilled = time.time()
+		self.index = {}		# Maps full IP:port address to its QueueEntry.
+		self.per_ip = {}	# Maps bare IP to number of entries queued from it.
+		self.due = []		# Heap of (due, seq, entry), lazily re-checked in flush().
+		self.seq = 0
 
+	def set_rate(self, rate):
+		self.rate = rate
+		self.burst = max(1.0, rate)
+		self.tokens = min(self.tokens, self.burst)
 
-class Queue:
-	def __init__(self, size = QUEUE_SIZE):
-		self.queue = [QueueEntry() for x in xrange(size)]
-		self.next = 0
-		self.load = 0
+	def _push(self, qe):
+		self.seq += 1
+		heapq.heappush(self.due, (qe.due, self.seq, qe))
 
-	def enqueue(self, ip):
-		self.queue[self.next].update(ip)
-		self.next += 1
-		self.next %= len(self.queue)
-		self.load += 1
+	def _forget(self, qe):
+		"""Drop the given entry from the lookup structures."""
+		del self.index[qe.ip]
+		n = self.per_ip[qe.justip] - 1
+		if n > 0:
+			self.per_ip[qe.justip] = n
+		else:
+			del self.per_ip[qe.justip]
+
+	def enqueue(self, ip, now):
+		"""Queue a DESCRIBE to the given address. Returns False if the table is full."""
+		if self.index.has_key(ip):	# Already waiting for it, keep to the schedule.
+			return True
+		if len(self.index) >= self.size:
+			self.flush(now)		# Might drop some stale entries.
+			if len(self.index) >= self.size:
+				return False
+		qe = QueueEntry(ip, now)
+		self.index[ip] = qe
+		self.per_ip[qe.justip] = self.per_ip.get(qe.justip, 0) + 1
+		self._push(qe)
+		self.flush(now)
+		return True
 
 	def unqueue(self, ip):
-		for i in xrange(len(self.queue)):
-			qe = self.queue[i]
-			if qe.has_address(ip):
-				self.queue[i].clear()
-				self.load -= 1
-				return True
-		return False
+		qe = self.index.get(ip)
+		if qe == None:
+			return False
+		self._forget(qe)
+		return True
+
+	def flush(self, now):
+		"""Send DESCRIBEs that are due, as far as the budget allows, and drop stale entries."""
+		self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+		self.refilled = now
+		while len(self.due) > 0 and self.due[0][0] <= now:
+			qe = self.due[0][2]
+			if self.index.get(qe.ip) is not qe:
+				heapq.heappop(self.due)		# Stale heap item, server answered.
+				continue
+			if qe.is_stale(now):
+				heapq.heappop(self.due)
+				self._forget(qe)
+				self.stats.count("describe.expired")
+				continue
+			if self.tokens < 1.0:
+				break
+			heapq.heappop(self.due)
+			self.tokens -= 1.0
+			if qe.tries > 0:
+				self.stats.count("describe.retried")
+			self.stats.count("describe.sent")
+			qe.update(now, self.transport)
+			self._push(qe)
+
+	def next_deadline(self):
+		"""Return time when flush() next has something to do, or None if idle."""
+		if len(self.due) == 0:
+			return None
+		due = self.due[0][0]
+		if self.tokens < 1.0:
+			due = max(due, self.refilled + (1.0 - self.tokens) / self.rate)
+		return due
 
 	def contains(self, ip):
-		"""Go through the entries list, and check if the given IP is there. Returns (boolean, count)."""
-		short = strip_ip(ip)
-		count = 0
-		for e in self.queue:
-			if e.ip == None: continue
-			if e.has_address(ip):
-				return (True, count)
-			elif e.has_ip(short):
-				count += 1
-			else:
-				print "No match for", e.ip
-		return (False, count)
+		"""Check if the given address is queued. Returns (boolean, count), where count is the number
+		   of *other* queued entries from the same IP."""
+		known = self.index.has_key(ip)
+		count = self.per_ip.get(strip_ip(ip), 0)
+		if known:
+			count -= 1
+		return (known, count)
 
 	def get_load(self):
-		return self.load % len(self.queue)
+		return len(self.index)
 
 
-class Database:
-	class Entry:
-		def quote(s):
-			"""Quote a string to comply with the Master server protocol's quoting rules."""
-			qs = ""
-			for x in s:
-				if x == '"': x = "\\\""
-				elif x == "\\": x = "\\\\"
-				qs += x
-			return qs
-		quote = staticmethod(quote)
-
-		def __init__(self, ip):
-	    		if ":" in ip:
-				colon = ip.index(":")
-				self.ip = ip[:colon]
-				self.port = int(ip[colon+1:])
+class Limiter:
+	"""Front-door admission control for incoming pings. Each kind of ping has its own token
+	   buckets per source IP and per /24, and a ping is let in only if both have a token. The
+	   buckets are kept in least-recently-used order, and the oldest are forgotten when there
+	   are too many, so a flood of spoofed sources can't make it grow without bound."""
+	def __init__(self, stats, limits = LIMITS, size = LIMITER_SIZE):
+		self.stats = stats
+		self.limits = limits
+		self.buckets = msparse.Cache(size, lambda key, b: stats.count("limit.evicted"))	# Maps (kind, IP, prefix) to [tokens, refilled].
+
+	def _take(self, key, rate, burst, now):
+		b = self.buckets.get(key)
+		if b == None:
+			b = [burst, now]
+			self.buckets.put(key, b)
+		else:
+			b[0] = min(burst, b[0] + (now - b[1]) * rate)
+			b[1] = now
+		if b[0] < 1.0:
+			return False
+		b[0] -= 1.0
+		return True
+
+	def admit(self, kind, address, now):
+		"""Return True if a ping of the given kind from the given address is to be handled."""
+		limit = self.limits.get(kind)
+		key = pack_address(address)
+		if limit == None or key == None:
+			return True
+		ip = key >> 16
+		(ip_rate, ip_burst), (net_rate, net_burst) = limit
+		if not self._take((kind, ip, 32), ip_rate, ip_burst, now):
+			self.stats.count("limit.rejected.%s.ip" % kind)
+			return False
+		if not self._take((kind, ip & 0xffffff00, 24), net_rate, net_burst, now):
+			self.stats.count("limit.rejected.%s.net" % kind)
+			return False
+		return True
+
+
+def write_snapshot(path, records):
+	"""Write registry records to a snapshot file. The file is written under a temporary name,
+	   synced, and then renamed into place, so a crash never leaves a partial snapshot."""
+	tmp = path + ".tmp"
+	f = open(tmp, "wb")
+	marshal.dump((SNAPSHOT_MAGIC, time.time(), records), f)
+	f.flush()
+	os.fsync(f.fileno())
+	f.close()
+	os.rename(tmp, path)
+
+def read_snapshot(path):
+	"""Read registry records from a snapshot file, as a list of (key, desc, tags, time) tuples."""
+	f = open(path, "rb")
+	try:
+		magic, written, records = marshal.load(f)
+	finally:
+		f.close()
+	if magic != SNAPSHOT_MAGIC:
+		raise ValueError("%s is not a master server snapshot" % path)
+	return records
+
+
+class Capture:
+	"""Appends every incoming ping to a file, for replay.py. The file is a sequence of marshalled
+	   (time, address, message) tuples, after a (CAPTURE_MAGIC, time) header when new. Writes
+	   are buffered, and pushed out by flush() at most CAPTURE_FLUSH seconds later. If writing
+	   fails, as on a full disk, capturing stops; flush() then returns False."""
+	def __init__(self, path, stats, log):
+		self.path = path
+		self.stats = stats
+		self.log = log
+		new = not os.path.exists(path) or os.path.getsize(path) == 0
+		self.f = open(path, "ab")
+		if new:
+			marshal.dump((CAPTURE_MAGIC, time.time()), self.f)
+		self.due = None
+
+	def record(self, address, message):
+		if self.f == None:
+			return
+		now = time.time()
+		try:
+			marshal.dump((now, address, message), self.f)
+		except (IOError, OSError), e:
+			self._failed(e)
+			return
+		if self.due == None:
+			self.due = now + CAPTURE_FLUSH
+
+	def next_deadline(self):
+		return self.due
+
+	def flush(self):
+		if self.due != None and self.f != None:
+			try:
+				self.f.flush()
+			except (IOError, OSError), e:
+				self._failed(e)
+		self.due = None
+		return self.f != None
+
+	def _failed(self, e):
+		self.stats.count("capture.failed")
+		self.log.error("Couldn't write capture to %s, capture stopped: %s", self.path, e)
+		try:
+			self.f.close()
+		except (IOError, OSError):
+			pass		# Buffered records are lost, nothing to be done.
+		self.f = None
+
+def read_capture(path):
+	"""Yield the (time, address, message) records of a capture file, oldest first. A record cut
+	   short at the end, as when the master was killed mid-write, is ignored."""
+	f = open(path, "rb")
+	try:
+		try:
+			magic, started = marshal.load(f)
+		except (EOFError, ValueError, TypeError):
+			raise ValueError("%s is not a master server capture" % path)
+		if magic != CAPTURE_MAGIC:
+			raise ValueError("%s is not a master server capture" % path)
+		while 1:
+			try:
+				yield marshal.load(f)
+			except (EOFError, ValueError, TypeError):
+				return
+	finally:
+		f.close()
+
+
+class Snapshotter:
+	"""Periodically writes registry records to a snapshot file. Done in a forked child where
+	   possible, so the caller's loop goes on while the child serializes its copy-on-write view
+	   of the registry. The records argument is a function returning the records to write."""
+	def __init__(self, path, records, stats, log, period = SNAPSHOT_PERIOD):
+		self.path = path
+		self.records = records
+		self.stats = stats
+		self.log = log
+		self.period = period
+		self.due = time.time() + period
+		self.pid = None
+
+	def poll(self, now):
+		if now >= self.due:
+			self.save()
+			self.due = now + self.period
+
+	def save(self):
+		if self.pid != None:
+			pid, status = os.waitpid(self.pid, os.WNOHANG)
+			if pid == 0:
+				return		# Previous snapshot still being written, skip this one.
+			self.pid = None
+			self.stats.count(["snapshot.saved", "snapshot.failed"][status != 0])
+		if hasattr(os, "fork"):
+			pid = os.fork()
+			if pid != 0:
+				self.pid = pid
+				return
+			status = 1
+			try:
+				write_snapshot(self.path, self.records())
+				status = 0
+			finally:
+				os._exit(status)
+		try:
+			write_snapshot(self.path, self.records())
+			self.stats.count("snapshot.saved")
+		except (IOError, OSError), e:
+			self.stats.count("snapshot.failed")
+			self.log.error("Couldn't write snapshot: %s", e)
+
+
+class Channel:
+	"""A stream of marshalled operations over a local socket, between the owner process and a
+	   worker. Operations are queued with put(), and sent as one length-prefixed frame by flush().
+	   The socket never blocks: if both ends were stuck sending to each other, neither would read.
+	   What it doesn't take is kept, and sent by later calls to flush(), once select() finds the
+	   socket writable; see pending(). Frames hold at most CHANNEL_FRAME_OPS operations, so a
+	   large batch, as when a snapshot is restored, is neither copied around nor parsed whole."""
+	def __init__(self, sock):
+		self.sock = sock
+		self.sock.setblocking(0)
+		self.inbuf = ""
+		self.out = []
+		self.frames = collections.deque()	# Framed data not yet taken by the socket.
+		self.sent = 0				# Bytes of the first frame already taken.
+
+	def put(self, op):
+		self.out.append(op)
+
+	def pending(self):
+		"""Return True if there is data waiting for the socket to become writable."""
+		return len(self.frames) > 0
+
+	def flush(self):
+		"""Send queued operations, as far as the socket takes them. Raises socket.error if the
+		   other end is gone."""
+		for i in xrange(0, len(self.out), CHANNEL_FRAME_OPS):
+			data = marshal.dumps(self.out[i:i + CHANNEL_FRAME_OPS])
+			self.frames.append(struct.pack("!I", len(data)) + data)
+		self.out = []
+		while len(self.frames) > 0:
+			frame = self.frames[0]
+			try:
+				n = self.sock.send(buffer(frame, self.sent))
+			except socket.error, e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+					return
+				raise
+			self.sent += n
+			if self.sent == len(frame):
+				self.frames.popleft()
+				self.sent = 0
+
+	def receive(self):
+		"""Read what is available, and return the list of operations in complete frames. Raises
+		   EOFError if the other end is gone."""
+		try:
+			data = self.sock.recv(65536)
+		except socket.error, e:
+			if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				return []
+			raise
+		if data == "":
+			raise EOFError("channel closed")
+		buf = self.inbuf + data
+		ops = []
+		pos = 0
+		while len(buf) - pos >= 4:
+			n = struct.unpack_from("!I", buf, pos)[0]
+			if len(buf) - pos < 4 + n:
+				break
+			ops.extend(marshal.loads(buffer(buf, pos + 4, n)))
+			pos += 4 + n
+		self.inbuf = buf[pos:]
+		return ops
+
+
+class Histogram:
+	"""Counts of durations, in power-of-two microsecond buckets. Cheap to add to."""
+	def __init__(self):
+		self.buckets = [0] * 32
+		self.count = 0
+		self.total = 0.0
+
+	def add(self, seconds):
+		self.buckets[min(31, int(seconds * 1e6).bit_length())] += 1
+		self.count += 1
+		self.total += seconds
+
+	def percentile(self, p):
+		"""Return upper bound, in microseconds, of the bucket holding the p:th percentile."""
+		want = self.count * p / 100.0
+		n = 0
+		for i in xrange(len(self.buckets)):
+			n += self.buckets[i]
+			if n > 0 and n >= want:
+				return 1 << i
+		return 0
+
+
+class Stats:
+	"""Named counters and duration histograms, kept by the Database."""
+	def __init__(self):
+		self.started = time.time()
+		self.counters = {}
+		self.histograms = {}
+
+	def count(self, name, n = 1):
+		self.counters[name] = self.counters.get(name, 0) + n
+
+	def time(self, name, seconds):
+		h = self.histograms.get(name)
+		if h == None:
+			h = self.histograms[name] = Histogram()
+		h.add(seconds)
+
+	def report(self, gauges = {}):
+		"""Return a list of text lines, one per counter, gauge and histogram."""
+		lines = ["uptime %.1f" % (time.time() - self.started)]
+		for name in sorted(self.counters.keys()):
+			lines.append("%s %u" % (name, self.counters[name]))
+		for name in sorted(gauges.keys()):
+			lines.append("%s %u" % (name, gauges[name]))
+		for name in sorted(self.histograms.keys()):
+			h = self.histograms[name]
+			lines.append("%s count=%u total_us=%u p50_us=%u p90_us=%u p99_us=%u" % (name, h.count, h.total * 1e6,
+				h.percentile(50), h.percentile(90), h.percentile(99)))
+		return lines
+
+
+class Log:
+	"""Leveled logging that never blocks the caller on output. Messages are formatted only if
+	   their level is enabled, and buffered; flush() hands them to a writer thread, so a slow
+	   terminal or pipe only ever delays the writer. If it falls too far behind, lines are
+	   dropped and counted instead. Repetitive messages can be limited per second, see limited()."""
+	def __init__(self, level = LOG_INFO, out = None):
+		self.level = level
+		self.out = out or sys.stdout
+		self.lines = []		# Formatted lines, not yet handed to the writer.
+		self.pending = []	# Lines handed to the writer, guarded by ready.
+		self.ready = threading.Condition()
+		self.writer = None
+		self.dropped = 0
+		self.bursts = {}	# Maps key to [second, messages, suppressed, level] for limited().
+
+	def enabled(self, level):
+		return level <= self.level
+
+	def log(self, level, fmt, *args):
+		if level > self.level:
+			return
+		if len(self.lines) >= LOG_BACKLOG:
+			self.dropped += 1
+			return
+		if len(args) > 0:
+			fmt = fmt % args
+		self.lines.append(fmt + "\n")
+
+	def error(self, fmt, *args):
+		self.log(LOG_ERROR, fmt, *args)
+
+	def info(self, fmt, *args):
+		self.log(LOG_INFO, fmt, *args)
+
+	def debug(self, fmt, *args):
+		self.log(LOG_DEBUG, fmt, *args)
+
+	def limited(self, key, level, fmt, *args):
+		"""Like log(), but lets at most LOG_BURST messages with the same key through each second.
+		   The number of suppressed ones is logged once the second is over."""
+		if level > self.level:
+			return
+		now = int(time.time())
+		b = self.bursts.get(key)
+		if b == None or b[0] != now:
+			self._summarize(key, b)
+			b = self.bursts[key] = [now, 0, 0, level]
+		b[1] += 1
+		if b[1] > LOG_BURST:
+			b[2] += 1
+			return
+		self.log(level, fmt, *args)
+
+	def _summarize(self, key, b):
+		if b != None and b[2] > 0:
+			self.log(b[3], "(%u more '%s' messages suppressed)", b[2], key)
+
+	def next_deadline(self):
+		"""Return time when flush() has lines to hand over or suppressed messages to sum up, or None."""
+		if len(self.lines) > 0:
+			return 0.0
+		if len(self.bursts) == 0:
+			return None
+		return min([b[0] for b in self.bursts.itervalues()]) + 1.0
+
+	def flush(self):
+		"""Hand buffered lines over to the writer thread, starting it if needed."""
+		if len(self.bursts) > 0:
+			now = int(time.time())
+			for key, b in self.bursts.items():
+				if b[0] != now:
+					self._summarize(key, b)
+					del self.bursts[key]
+		if self.dropped > 0 and len(self.lines) < LOG_BACKLOG:
+			self.lines.append("(%u log lines dropped)\n" % self.dropped)
+			self.dropped = 0
+		if len(self.lines) == 0:
+			return
+		if self.writer == None:
+			self.writer = threading.Thread(target = self._write)
+			self.writer.daemon = True
+			self.writer.start()
+		self.ready.acquire()
+		if len(self.pending) < LOG_BACKLOG:
+			self.pending.extend(self.lines)
+			self.ready.notify()
+		else:
+			self.dropped += len(self.lines)
+		self.ready.release()
+		self.lines = []
+
+	def _write(self):
+		while 1:
+			self.ready.acquire()
+			while len(self.pending) == 0:
+				self.ready.wait()
+			lines = self.pending
+			self.pending = []
+			self.ready.release()
+			self._output(lines)
+
+	def _output(self, lines):
+		try:
+			self.out.write("".join(lines))
+			self.out.flush()
+		except IOError:
+			pass
+
+	def close(self):
+		"""Write out everything still buffered, in the caller's thread. Used before exiting."""
+		self.ready.acquire()
+		lines = self.pending + self.lines
+		self.pending = []
+		self.lines = []
+		self.ready.release()
+		self._output(lines)
+
+
+class Profiler:
+	"""An opt-in profiler for the main loop, switched on and off by SIGUSR1 without restarting.
+	   While on, it sums up wall time per phase of the loop, and samples the stack every
+	   PROFILE_INTERVAL of CPU time. Switching off, or SIGUSR2, writes what was gathered so far
+	   to a file. Signal handlers only note requests; poll() acts on them from the loop."""
+	def __init__(self, path, log, interval = PROFILE_INTERVAL):
+		self.path = path
+		self.log = log
+		self.interval = interval
+		self.on = False
+		self.requests = []	# "toggle" or "dump", appended by signal handlers.
+		self._reset()
+		signal.signal(signal.SIGUSR1, lambda sig, frame: self.requests.append("toggle"))
+		signal.signal(signal.SIGUSR2, lambda sig, frame: self.requests.append("dump"))
+		signal.signal(signal.SIGPROF, self._sample)
+		for sig in (signal.SIGUSR1, signal.SIGUSR2, signal.SIGPROF):
+			signal.siginterrupt(sig, False)	# Restart system calls, rather than failing them.
+
+	def _reset(self):
+		self.started = time.time()
+		self.turns = 0
+		self.phases = {}	# Maps phase name to [total seconds, max seconds].
+		self.samples = {}	# Maps stack, as a tuple of "function:line" outermost first, to count.
+
+	def _sample(self, sig, frame):
+		stack = []
+		while frame != None and len(stack) < PROFILE_DEPTH:
+			stack.append("%s:%u" % (frame.f_code.co_name, frame.f_lineno))
+			frame = frame.f_back
+		stack.reverse()
+		stack = tuple(stack)
+		self.samples[stack] = self.samples.get(stack, 0) + 1
+
+	def turn(self, flush, clean, wait):
+		"""Account for one turn of the main loop, given the wall time of each phase."""
+		if not self.on:
+			return
+		self.turns += 1
+		for name, elapsed in (("flush", flush), ("clean", clean), ("wait", wait)):
+			p = self.phases.get(name)
+			if p == None:
+				self.phases[name] = [elapsed, elapsed]
+			else:
+				p[0] += elapsed
+				p[1] = max(p[1], elapsed)
+
+	def poll(self):
+		"""Act on signals received since last time."""
+		while len(self.requests) > 0:
+			r = self.requests.pop(0)
+			if r == "toggle" and not self.on:
+				self._reset()
+				self.on = True
+				signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+				self.log.info("Loop profiler on, SIGUSR1 again to stop and write %s", self.path)
+			elif r == "toggle":
+				signal.setitimer(signal.ITIMER_PROF, 0.0)
+				self.on = False
+				self.dump()
 			else:
-				self.ip = ip
-				self.port = VERSE_PORT
-			self.key = "%s:%u" % (self.ip, self.port)
+				self.dump()
+
+	def dump(self):
+		"""Write phase times and the most common stacks to the profile file."""
+		elapsed = max(time.time() - self.started, 1e-9)
+		total = max(1, sum(self.samples.itervalues()))
+		out = ["Loop profile over %.1f s, %u turns, %u stack samples every %.1f ms of CPU time" % (elapsed,
+			self.turns, sum(self.samples.itervalues()), 1000.0 * self.interval), "",
+			"phase      total s  share    mean us     max us"]
+		for name in sorted(self.phases.keys()):
+			t, m = self.phases[name]
+			out.append("%-8s %9.3f %5.1f%% %10.1f %10.1f" % (name, t, 100.0 * t / elapsed, 1e6 * t / max(1, self.turns), 1e6 * m))
+		out += ["", "samples  share  stack, outermost first"]
+		stacks = sorted(self.samples.iteritems(), key = lambda s: s[1], reverse = True)
+		for stack, n in stacks[:PROFILE_TOP]:
+			out.append("%7u %5.1f%%  %s" % (n, 100.0 * n / total, " > ".join(stack)))
+		try:
+			f = open(self.path, "w")
+			f.write("\n".join(out) + "\n")
+			f.close()
+			self.log.info("Wrote loop profile to %s", self.path)
+		except IOError, e:
+			self.log.error("Couldn't write loop profile to %s: %s", self.path, e)
+
+
+class VerseTransport:
+	"""Sends and receives pings through the verse module, which is polled."""
+	def __init__(self):
+		if v == None:
+			raise ImportError("The verse module is needed for the verse transport")
+
+	def open(self, port, handler):
+		v.set_port(port)
+		v.callback_set(v.SEND_PING, handler)
+
+	def send(self, address, message):
+		v.send_ping(address, message)
+
+	def wait(self, deadline):
+		"""Handle incoming pings until the deadline (None for no limit) passed, but at most for
+		   VERSE_WAIT_MAX seconds. Verse returns early if pings arrive."""
+		timeout = VERSE_WAIT_MAX
+		if deadline != None:
+			timeout = min(timeout, max(0.0, deadline - time.time()))
+		v.callback_update(int(timeout * 1000000))
+
+
+class SocketTransport:
+	"""Sends and receives Verse ping datagrams on a plain UDP socket, without the verse module.
+	   Waiting blocks in select() until a datagram arrives or the given deadline passes, so an
+	   idle master does not spin."""
+	PING_HEADER = struct.pack(">IB", 0, 5)	# Packet ID 0 (connectionless), command 5 (ping).
+
+	def __init__(self, reuse = False):
+		self.sock = None
+		self.handler = None
+		self.reuse = reuse	# Let several processes bind the same port, see Owner.
+		self.watched = {}
+		self.pending = {}	# Maps watched socket to function telling if output is waiting.
+
+	def open(self, port, handler):
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		if self.reuse:
+			self.sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+		self.sock.bind(("", port))
+		self.sock.setblocking(0)
+		self.handler = handler
+
+	def encode(message):
+		"""Wrap a ping message into a datagram."""
+		return SocketTransport.PING_HEADER + message + "\0"
+	encode = staticmethod(encode)
+
+	def decode(data):
+		"""Extract the message from a ping datagram, or return None if it is not one."""
+		if not data.startswith(SocketTransport.PING_HEADER):
+			return None
+		end = data.find("\0", len(SocketTransport.PING_HEADER))
+		if end < 0:
+			return None
+		return data[len(SocketTransport.PING_HEADER):end]
+	decode = staticmethod(decode)
+
+	def send(self, address, message):
+		host = strip_ip(address)
+		if ":" in address:
+			port = int(address[address.index(":") + 1:])
+		else:
+			port = VERSE_PORT
+		try:
+			self.sock.sendto(SocketTransport.encode(message), (host, port))
+		except socket.error:
+			pass		# UDP is lossy anyway; a full buffer or bad address just drops it.
+
+	def watch(self, sock, callback, pending = None):
+		"""Have wait() also call callback whenever sock becomes readable, and return as soon as it
+		   becomes writable, if the pending function says there is output waiting for it."""
+		self.watched[sock] = callback
+		if pending != None:
+			self.pending[sock] = pending
+
+	def wait(self, deadline):
+		"""Handle incoming pings until at least one arrived, or the deadline (None for no limit) passed."""
+		timeout = None
+		if deadline != None:
+			timeout = max(0.0, deadline - time.time())
+		try:
+			r, w, x = select.select([self.sock] + self.watched.keys(), [s for s, p in self.pending.iteritems() if p()], [], timeout)
+		except select.error, e:
+			if e.args[0] == errno.EINTR:
+				return		# A signal, see Profiler. The caller comes right back.
+			raise
+		for sock in r:
+			if sock is not self.sock:
+				self.watched[sock]()
+		if not self.sock in r:
+			return
+		while 1:
+			try:
+				data, addr = self.sock.recvfrom(2048)
+			except socket.error:
+				return
+			msg = SocketTransport.decode(data)
+			if msg != None:
+				self.handler("%s:%u" % addr, msg)
+
+
+class Federation:
+	"""Replicates the servers registered with us to peer masters, so that any of them can answer
+	   GETs with the full set. Changes are sent in MS:SYNC pings, numbered per peer; a peer that
+	   sees a gap in the numbers, or a new epoch, asks for the full set with MS:RESYNC. Servers
+	   removed while we were cut off simply expire on the peer, like any other."""
+	class Peer:
+		def __init__(self, address):
+			self.address = address
+			self.seq = 0		# Sequence number of last packet sent to it.
+			self.epoch = None	# Its epoch, and last sequence number received from it.
+			self.last = 0
+			self.asked = 0.0	# Time we last asked it for a resync.
+
+	def __init__(self, db, peers):
+		self.db = db
+		self.epoch = random.randint(1, 0x7fffffff)
+		self.peers = dict([(p, Federation.Peer(p)) for p in peers])
+		self.changed = set()	# Keys of local servers that are new or changed.
+		self.touched = set()	# Keys of local servers that have only been touched.
+		self.removed = set()	# Keys of local servers that are gone.
+		self.soon = None	# When changed and removed are due to be sent.
+		self.due = time.time()	# When the next periodic sync is due.
+
+	def change(self, key):
+		self.changed.add(key)
+		if self.soon == None:
+			self.soon = time.time() + SYNC_DELAY
+
+	def touch(self, key):
+		self.touched.add(key)
+
+	def remove(self, key):
+		self.removed.add(key)
+		if self.soon == None:
+			self.soon = time.time() + SYNC_DELAY
+
+	def next_deadline(self):
+		if self.soon != None and self.soon < self.due:
+			return self.soon
+		return self.due
+
+	def flush(self, now):
+		if now >= self.due:
+			keys = self.changed | self.touched
+			self.touched = set()
+			self.due = now + SYNC_PERIOD
+		elif self.soon != None and now >= self.soon:
+			keys = self.changed
+		else:
+			return
+		ops = self._ops(keys, self.removed, now)
+		self.changed = set()
+		self.removed = set()
+		self.soon = None
+		for p in self.peers.values():
+			self._send(p, ops)
+
+	def _ops(self, keys, removed, now):
+		"""Return a list of text operations describing the current state of the given keys."""
+		ops = []
+		for key in keys | removed:
+			e = self.db.servers.get(key)
+			if e == None:
+				if key in removed:
+					ops.append(" RM=" + unpack_address(key))
+			elif e.origin == None:
+				op = " AD=%s AG=%u" % (e.address(), max(0, now - e.time))
+				if e.tags != "":
+					op += " TA=" + e.tags
+				ops.append(op + ' DE="%s"' % e.desc)
+		return ops
+
+	def _send_all(self, peer, now):
+		self.db.stats.count("sync.full")
+		self._send(peer, self._ops(set([e.key for e in self.db.servers.itervalues() if e.origin == None]), set(), now))
+
+	def _send(self, peer, ops):
+		"""Pack operations into as few MS:SYNC packets as possible, and send them. Sends a single
+		   empty one if there are no operations, so the peer knows we're alive."""
+		packets = []
+		pack = []
+		size = 0
+		for op in ops:
+			if size + len(op) > self.db.packet_size - 40 and len(pack) > 0:	# Leave room for the header.
+				packets.append(pack)
+				pack = []
+				size = 0
+			pack.append(op)
+			size += len(op)
+		packets.append(pack)
+		for pack in packets:
+			peer.seq += 1
+			self.db.transport.send(peer.address, "MS:SYNC EP=%u SQ=%u" % (self.epoch, peer.seq) + "".join(pack))
+			self.db.stats.count("sync.sent")
+
+	def receive(self, address, message):
+		peer = self.peers.get(address)
+		if peer == None:
+			self.db.stats.count("sync.refused")
+			return
+		now = time.time()
+		if message.startswith("MS:RESYNC"):
+			self._send_all(peer, now)
+			return
+		try:
+			pairs = msparse.parse_pairs(message[7:])
+			epoch, seq = int(pairs[0][1]), int(pairs[1][1])
+			ops = self._parse_ops(pairs[2:])
+		except (msparse.ParseError, IndexError, ValueError):
+			self.db.stats.count("sync.malformed")
+			return
+		self.db.stats.count("sync.received")
+		if epoch != peer.epoch:		# Peer is new, or restarted: it has nothing of ours.
+			self._send_all(peer, now)
+		if (epoch != peer.epoch or seq != peer.last + 1) and now - peer.asked >= RESYNC_HOLDOFF:
+			self.db.transport.send(address, "MS:RESYNC")
+			peer.asked = now
+		peer.epoch = epoch
+		peer.last = seq
+		for op in ops:
+			if op.has_key("AD"):
+				self.db.replicate(address, op["AD"], now - op["AG"], op.get("DE", ""), op.get("TA", ""))
+			else:
+				self.db.unreplicate(address, op["RM"])
+
+	def _parse_ops(self, pairs):
+		"""Group the AD= and RM= operations of a SYNC into dictionaries, in order. Ages are
+		   turned into numbers, clamped to what a live server can have; raises ValueError if
+		   one isn't a number."""
+		ops = []
+		for key, value in pairs:
+			if key in ("AD", "RM"):
+				ops.append({ key: value })
+			elif len(ops) > 0:
+				ops[-1][key] = value
+		for op in ops:
+			if op.has_key("AD"):
+				op["AG"] = max(0, min(SERVER_TIMEOUT, int(op.get("AG", 0))))
+		return ops
+
+
+class Database:
+	class Entry(object):
+		"""A registered server. Kept small, since there can be very many: the address is packed
+		   into the integer key, and descriptions and tag sets are interned, so that equal ones
+		   are shared between entries."""
+		__slots__ = ("key", "desc", "tags", "time", "fields", "fragment", "origin")
+
+		def __init__(self, key, origin = None):
+			self.key = key		# Packed address, see pack_address().
+			self.origin = origin	# Address of peer master it was replicated from, or None.
 			self.desc = ""
-			self.tags = [ ]
+			self.tags = ""		# Sorted, comma-separated, interned.
 			self.time = 0
+			self.fields = None	# Field tuple that fragment was built for.
+			self.fragment = None	# Serialized build_list() output.
+
+		def address(self):
+			return unpack_address(self.key)
 
 		def set_desc(self, desc):
-			self.desc = Database.Entry.quote(desc)
+			self.desc = intern(msparse.quote(desc[:DESCRIPTION_MAX]))
+			self.fragment = None
 
 		def set_tags(self, tags):
-			ts = tags.split(",")
-			self.tags = [t for t in ts if is_tag(t)]	# Replace with any valid tags.
-			print "tags now:", self.tags
+			ts = sorted(set([t for t in tags.split(",") if is_tag(t)]))	# Replace with any valid tags.
+			self.tags = intern(",".join(ts))
+
+		def tag_list(self):
+			if self.tags == "":
+				return []
+			return self.tags.split(",")
 
 		def touch(self):
 			self.time = time.time()
 
-		def filter_tags(self, incl = None, excl = None):
-			"""Filters based on two lists of tags to include and exclude."""
-			if incl != None:
-				for i in incl:
-					if not i in self.tags: return False
-			if excl != None:
-				for e in excl:
-					if e in self.tags: return False
-			return True
-
 		def build_list(self, what):
-			txt = " "
-			if what.has_key("IP"):
-				txt += "IP=" + self.ip
-				if self.port != VERSE_PORT:
-					txt += ":%u" % self.port
-				if what.has_key("IP"):
-					for w in what["IP"]:
-						if w == "DE":
-							txt += " DE=\"%s\"" % self.desc
-			return txt
+			fields = what.get("IP")
+			if fields != None:
+				fields = tuple(fields)
+			if self.fragment != None and self.fields == fields:
+				return self.fragment
+			txt = [" "]
+			if fields != None:
+				txt.append("IP=" + list_address(self.key))
+				for w in fields:
+					if w == "DE":
+						txt.append(" DE=\"%s\"" % self.desc)
+			self.fields = fields
+			self.fragment = "".join(txt)
+			return self.fragment
 
 	class ListJob:
-		"""A bunch of MS:LISTS packets, with a target address."""
-		def __init__(self, ip, packets):
+		"""A bunch of MS:LISTS packets, with a target address. The packets are never modified,
+		   so they can be shared; sending just moves a position forward."""
+		def __init__(self, ip, packets, now, key = None):
 			self.ip = ip
 			self.packets = packets
-			self.time = time.time()
-			self.start = self.time
+			self.key = key		# What was asked for, to spot repeated GETs.
+			self.pos = 0
+			self.time = now		# When the next packet is due.
+			self.start = now
 
-		def flush(self):
-			now = time.time()
-			if now - self.time >= LIST_PERIOD:
-				v.send_ping(self.ip, self.packets[0])
-				self.packets = self.packets[1:]
-				self.time = now
-			return len(self.packets) == 0
+		def send(self, now, transport):
+			"""Send the next packet, and schedule the one after it. Returns True when done."""
+			transport.send(self.ip, self.packets[self.pos])
+			self.pos += 1
+			self.time = now + LIST_PERIOD
+			return self.pos >= len(self.packets)
 
 		def age(self):
 			return time.time() - self.start
 
 	class ListJobs:
-		"""A bunch of ListJob instances."""
-		def __init__(self):
-			self.jobs = []
-			self.ip = None
-			self.olen = 0
-
-		def add(self, ip, packets):
-			if len(packets) > 0:	# No point in sending out an empty list.
-				j = Database.ListJob(ip, packets)
-				self.jobs += [j]
-				self.ip = ip
-				self.olen = len(packets)
+		"""A bunch of ListJob instances, kept in a heap ordered by when their next packet is due.
+		   Sending is limited by a global packets-per-second budget, and by how many jobs a
+		   single IP can have running at once."""
+		def __init__(self, transport, stats, log, rate = LIST_RATE, per_ip = MAX_JOBS_PER_IP):
+			self.transport = transport
+			self.stats = stats
+			self.log = log
+			self.jobs = []		# Heap of (due time, sequence, job).
+			self.seq = 0
+			self.per_ip = {}	# Maps bare IP to its number of running jobs.
+			self.running = {}	# Maps (IP, key) to running job, for jobs with a key.
+			self.max_per_ip = per_ip
+			self.set_rate(rate)
+
+		def set_rate(self, rate):
+			"""Set global budget, in packets per second. Up to one second's worth can burst, and
+			   at least one packet, so that rates below one per second still send."""
+			self.rate = float(rate)
+			self.burst = max(1.0, self.rate)
+			self.tokens = self.burst
+			self.refilled = time.time()
+
+		def add(self, ip, packets, key = None):
+			"""Start sending the packets to ip. Returns False if that IP has too many jobs already.
+			   If a job with the same key is already running to ip, that job is reused instead: if
+			   it has sent nothing yet it takes the new packets, else it carries on as it was."""
+			if len(packets) == 0:	# No point in sending out an empty list.
+				return True
+			if key != None:
+				j = self.running.get((ip, key))
+				if j != None:
+					if j.pos == 0:
+						j.packets = packets
+					self.stats.count("get.coalesced")
+					return True
+			adr = strip_ip(ip)
+			n = self.per_ip.get(adr, 0)
+			if n >= self.max_per_ip:
+				return False
+			self.per_ip[adr] = n + 1
+			j = Database.ListJob(ip, packets, time.time(), key)
+			if key != None:
+				self.running[(ip, key)] = j
+			self._push(j)
+			return True
+
+		def _push(self, j):
+			heapq.heappush(self.jobs, (j.time, self.seq, j))
+			self.seq += 1
 
 		def flush(self):
-			for j in self.jobs:
-				if j.flush():
-					print "Sent", self.olen, "packets of MS:LIST data to", self.ip
-					self.jobs.remove(j)
+			now = time.time()
+			self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+			self.refilled = now
+			while len(self.jobs) > 0 and self.jobs[0][0] <= now and self.tokens >= 1.0:
+				j = heapq.heappop(self.jobs)[2]
+				self.tokens -= 1.0
+				self.stats.count("list.packets")
+				self.stats.count("list.bytes", len(j.packets[j.pos]))
+				if j.send(now, self.transport):
+					self.log.debug("Sent %u packets of MS:LIST data to %s", len(j.packets), j.ip)
+					if j.key != None:
+						del self.running[(j.ip, j.key)]
+					adr = strip_ip(j.ip)
+					n = self.per_ip[adr] - 1
+					if n > 0:
+						self.per_ip[adr] = n
+					else:
+						del self.per_ip[adr]
+				else:
+					self._push(j)
 
-	def __init__(self, port = 5666, talk = True):
+		def next_deadline(self):
+			"""Return time when flush() next has a packet to send, or None if idle."""
+			if len(self.jobs) == 0:
+				return None
+			due = self.jobs[0][0]
+			if self.tokens < 1.0:
+				due = max(due, self.refilled + (1.0 - self.tokens) / self.rate)
+			return due
+
+	def __init__(self, port = 5666, level = LOG_INFO, transport = None):
 		"""Create new empty database and request handler. It's a ... mashup."""
-		self.queue = Queue()
+		if transport == None:
+			transport = VerseTransport()
+		self.transport = transport
 		self.servers = {}
-		self.talk = talk
+		self.by_ip = {}		# Maps packed bare IP to number of servers registered from it.
+		self.by_tag = {}	# Maps tag to set of keys of servers having it.
+		self.expiry = []	# Heap of (deadline, entry), lazily re-checked in clean().
+		self.generation = 0	# Bumped whenever the registry's listable contents change.
+		self.lists = msparse.Cache(LIST_CACHE_SIZE)	# Cached packet lists by GET query, valid for lists_generation.
+		self.lists_generation = 0
+		self.packet_size = PACKET_MTU - PACKET_OVERHEAD	# Max length of a ping we send.
+		self.epoch = random.randint(1, 0x7fffffff)	# Tells generations of different runs apart.
+		self.changelog = collections.deque()	# (generation, key) for recent changes, oldest first.
+		self.changelog_floor = 0		# Changes after this generation are all in the changelog.
+		self.log = Log(level)
 		self.talked_last = time.time()
-		self.listjobs = Database.ListJobs()
-		if self.talk:
-			print "Listening to port %u, ready for use." % port
-		v.set_port(port)
-		v.callback_set(v.SEND_PING,	self._cb_ping)
-		self.gets = 0
+		self.stats = Stats()
+		self.queue = Queue(transport, self.stats)
+		self.listjobs = Database.ListJobs(transport, self.stats, self.log)
+		self.limiter = Limiter(self.stats)
+		self.log.info("Listening to port %u, ready for use.", port)
+		transport.open(port, self._cb_ping)
 		self.local = None
+		self.snapshot = None
+		self.owner = None
+		self.federation = None
+		self.capture = None
+		self.profiler = None
 
 	def set_local(self, local):
 		"""Sets an IP address to use as replacement for announcements coming in from localhost."""
@@ -218,63 +1219,149 @@ class Database:
 			local = local[:local.index(":")]	# No port number in replacement, please.
 		self.local = socket.gethostbyname(local)	# Resolve if given textually.
 
-	def _parse(self, cmd):
-		"""Parse a received command into a dictionary of keyword=value pairs. Understands the
-		   quoting rules for Verse master server commands. This is a bit hackish, maybe."""
-		kw = { }
-		i = 0
-		l = len(cmd)
-#		print "parsing '%s', %u chars" % (cmd, l)
-		while i < l:
-			here = cmd[i]
-			if here.isspace():
-				i += 1
+	def set_snapshot(self, path, period = SNAPSHOT_PERIOD):
+		"""Enable periodic snapshots of the registry to the given file."""
+		self.snapshot = Snapshotter(path, lambda: [(e.key, e.desc, e.tags, e.time) for e in self.servers.itervalues() if e.origin == None], self.stats, self.log, period)
+
+	def set_capture(self, path):
+		"""Record every incoming ping to the given file, see Capture."""
+		self.capture = Capture(path, self.stats, self.log)
+
+	def set_profiler(self, path):
+		"""Let the main loop be profiled on signal, see Profiler."""
+		self.profiler = Profiler(path, self.log)
+
+	def set_peers(self, peers):
+		"""Replicate registered servers with the given peer master servers, see Federation."""
+		addresses = []
+		for p in peers:
+			host, colon, port = p.partition(":")
+			addresses.append("%s:%u" % (socket.gethostbyname(host), int(port or VERSE_PORT)))
+		self.federation = Federation(self, addresses)
+
+	def replicate(self, origin, address, t, desc, tags):
+		"""Register or update a server replicated from a peer master, unless it's registered here."""
+		key = pack_address(address)
+		if key == None:
+			return
+		old = self.servers.get(key)
+		if old != None and old.origin == None:
+			return
+		e = Database.Entry(key, origin)
+		e.set_desc(desc)
+		e.tags = intern(",".join(sorted(set([x for x in tags.split(",") if is_tag(x)]))))
+		e.time = t
+		if old != None:
+			if old.desc == e.desc and old.tags == e.tags:
+				old.time = max(old.time, t)
+				return
+			self._unregister(old)
+		self._register(e)
+
+	def unreplicate(self, origin, address):
+		"""Remove a server replicated from a peer master, which says it's gone."""
+		e = self.servers.get(pack_address(address))
+		if e != None and e.origin == origin:
+			self._unregister(e)
+
+	def set_owner(self, channel):
+		"""Run as a worker: registrations and touches are sent to the owner process, which sends
+		   back the changes to apply to our copy of the registry. The transport must be able to
+		   watch the channel, see SocketTransport.watch()."""
+		self.owner = channel
+		self.transport.watch(channel.sock, self._cb_owner, channel.pending)
+
+	def _lost_owner(self):
+		self.log.error("Lost contact with owner process, exiting")
+		self.log.close()
+		sys.exit(1)
+
+	def _cb_owner(self):
+		try:
+			ops = self.owner.receive()
+		except (EOFError, socket.error):
+			self._lost_owner()
+		for op in ops:
+			self.apply(op)
+
+	def apply(self, op):
+		"""Apply a registry change sent by the owner process."""
+		if op[0] == "add":
+			kind, key, desc, tags, t = op
+			old = self.servers.get(key)
+			if old != None:
+				self._unregister(old)
+			e = Database.Entry(key)
+			e.desc = intern(desc)
+			e.tags = intern(tags)
+			e.time = t
+			self._register(e)
+		elif op[0] == "touch":
+			e = self.servers.get(op[1])
+			if e != None:
+				e.time = op[2]
+		elif op[0] == "del":
+			e = self.servers.get(op[1])
+			if e != None:
+				self._unregister(e)
+
+	def load_snapshot(self, path):
+		"""Register the servers found in a snapshot file, with whatever lifetime they have left."""
+		try:
+			records = read_snapshot(path)
+		except (IOError, OSError, ValueError, EOFError, TypeError), x:
+			self.log.error("Couldn't load snapshot: %s", x)
+			return
+		now = time.time()
+		for key, desc, tags, t in records:
+			if now - t >= SERVER_TIMEOUT or self.servers.has_key(key):
 				continue
-			if here.isupper():
-				key = ""
-				while i < l and cmd[i].isupper():
-					key += cmd[i]
-					i += 1
-				if cmd[i] == '=':
-					i += 1
-					v = ""
-					if cmd[i] == '"':	# Quoted string?
-						i += 1
-						while i < l and not cmd[i] == '"':
-							if cmd[i] == '\\':
-								if i + 1 < l:
-									i += 1
-								else:
-									print "Error in quoting, aborting"
-									return None
-							v += cmd[i]
-							i += 1
-						if i < l and cmd[i] == '"':
-							i += 1		# Skip final quote.
-						else:
-							print "Missing final quote, aborting"
-							return None
-					else:
-						while i < l and not cmd[i].isspace():
-							if cmd[i] == '"' or cmd[i] == '\\':
-								print "No quotes or backslashes in unquoted strings please, aborting"
-								return None
-							v += cmd[i]
-							i += 1
-					kw[key] = v
-				else:
-					print "Keyword '%s' not followed by equals sign, aborting" % key
-					return None
-			else:
-				print "Expected upper-case key name, aborting parse of \"%s\"" % cmd
-				return None
-		return kw
+			e = Database.Entry(key)
+			e.desc = intern(desc)
+			e.tags = intern(tags)
+			e.time = t
+			self._register(e)
+		self.log.info("Restored %u servers from %s", len(self.servers), path)
+
+	def set_list_rate(self, rate):
+		"""Sets the global budget for outgoing MS:LIST packets, in packets per second."""
+		self.listjobs.set_rate(rate)
+
+	def set_mtu(self, mtu, overhead = PACKET_OVERHEAD):
+		"""Sets the max datagram size, and how much of it goes to headers rather than text. Raises
+		   ValueError unless the longest list entry fits, or if packets would be larger than with
+		   the default MTU; the C list parser in verse_ms.c only has room for that many words."""
+		size = mtu - overhead
+		if size < LIST_HEADER_ROOM + FRAGMENT_MAX or size > PACKET_MTU - PACKET_OVERHEAD:
+			raise ValueError("MTU %u is out of range, must be %u to %u" % (mtu, overhead + LIST_HEADER_ROOM + FRAGMENT_MAX, overhead + PACKET_MTU - PACKET_OVERHEAD))
+		self.packet_size = size
+		self.lists = msparse.Cache(LIST_CACHE_SIZE)	# Cached lists were packed for the old size.
+
+	def set_limits(self, limits):
+		"""Sets admission budgets for incoming pings, as in LIMITS. None disables the limits."""
+		if limits == None:
+			self.limiter = None
+		else:
+			self.limiter = Limiter(self.stats, limits)
+
+	def set_describe_rate(self, rate):
+		"""Sets the global budget for outgoing DESCRIBE requests, in requests per second."""
+		self.queue.set_rate(rate)
+
+	def _parse(self, cmd):
+		"""Parse a received command into a dictionary of keyword=value pairs, or None if it's
+		   malformed. Malformed commands are counted, but not reported one by one."""
+		try:
+			return msparse.parse(cmd)
+		except msparse.ParseError:
+			self.stats.count("parse.errors")
+			return None
 
 	# -----------------------------------------------------------------------------------------------------
 
 	def _replace_local(self, ip):
 		"""Remap requests from 127.0.0.1 to look as they come from the 'local' address, which is settable."""
-		if local != None and ip.startswith("127.0.0.1"):
+		if self.local != None and ip.startswith("127.0.0.1"):
 			if ":" in ip:
 				ci = ip.index(":")
 				tail = ip[ci:]
@@ -285,55 +1372,131 @@ class Database:
 
 	def announce(self, ip):
 		"""Handle an incoming announce-message from (presumably) a Verse server somewhere."""
+		key = pack_address(ip)
+		if key == None:
+			self.stats.count("announce.rejected.bad_address")
+			return
 		# First, check if the server is already registered.
-		if self.servers.has_key(ip):
+		e = self.servers.get(key)
+		if e != None and e.origin == None:
 			# Yes, so just touch the entry to keep it alive, don't reply.
-			e = self.servers[ip]
 			tl = SERVER_TIMEOUT - (time.time() - e.time)
-			e.touch()
-			if self.talk:
-				print "Got ANNOUNCE from known server", ip, "updating entry (%.3f s left)" % tl
+			self._touch(e)
+			self.stats.count("announce.known")
+			self.log.debug("Got ANNOUNCE from known server %s updating entry (%.3f s left)", ip, tl)
 			return
 		# If not found, go through the wait-queue, and see if we already have an outstanding
 		# request to that particular server.
 		(known, count) = self.queue.contains(ip)
+		if known:
+			self.stats.count("announce.pending")
+			self.log.debug("Got ANNOUNCE from %s, already waiting for its DESCRIPTION", ip)
+			return		# Keep to the DESCRIBE schedule already set up for it.
 		if count >= MAX_PER_IP:
-			if self.talk:
-				print "Ignoring ANNOUNCE from", ip + ", already have", count, "queued from the same IP"
+			self.stats.count("announce.rejected.queued_per_ip")
+			self.log.limited("announce.ignored", LOG_INFO, "Ignoring ANNOUNCE from %s, already have %u queued from the same IP", ip, count)
 			return
 		# Check that there are not too many *registered* servers from this IP, either.
-		adr = strip_ip(ip)
-		for e in self.servers.values():
-			if e.ip == adr:
-				count += 1
-			if count >= MAX_PER_IP:
-				break
+		count += self.by_ip.get(key >> 16, 0)
+		if e != None:
+			count -= 1	# Known through a peer master; will be replaced, not added.
 		if count >= MAX_PER_IP:
-			if self.talk:
-				print "Ignoring ANNOUNCE from", ip + ", already have", count, "queued or registered from that IP"
+			self.stats.count("announce.rejected.registered_per_ip")
+			self.log.limited("announce.ignored", LOG_INFO, "Ignoring ANNOUNCE from %s, already have %u queued or registered from that IP", ip, count)
+			return
+		if not self.queue.enqueue(ip, time.time()):
+			self.stats.count("announce.rejected.queue_full")
+			self.log.limited("announce.ignored", LOG_INFO, "Ignoring ANNOUNCE from %s, already have %u queued in total", ip, self.queue.get_load())
 			return
-		self.queue.enqueue(ip)
-		if self.talk:
-			print "Got ANNOUNCE from unknown server", ip +", queued (%u queued now)" % self.queue.get_load()
+		self.stats.count("announce.accepted")
+		self.log.info("Got ANNOUNCE from unknown server %s, queued (%u queued now)", ip, self.queue.get_load())
+
+	def _touch(self, e):
+		"""Keep a locally registered entry alive."""
+		e.touch()
+		if self.owner != None:
+			self.owner.put(("touch", e.key, e.time))
+		if self.federation != None:
+			self.federation.touch(e.key)
+
+	def _changed(self, key):
+		"""Note that the registry changed, for the given key."""
+		self.generation += 1
+		if len(self.changelog) >= CHANGELOG_SIZE:
+			self.changelog_floor = self.changelog.popleft()[0]
+		self.changelog.append((self.generation, key))
+
+	def _register(self, e):
+		"""Add a new, freshly touched, entry to the set of registered servers."""
+		self.servers[e.key] = e
+		self._changed(e.key)
+		if self.owner == None:		# Otherwise, the owner handles expiry.
+			heapq.heappush(self.expiry, (e.time + SERVER_TIMEOUT, e))
+		ip = e.key >> 16
+		self.by_ip[ip] = self.by_ip.get(ip, 0) + 1
+		self._index_tags(e, True)
+		if self.federation != None and e.origin == None:
+			self.federation.change(e.key)
+
+	def _unregister(self, e):
+		"""Remove an entry from the set of registered servers."""
+		del self.servers[e.key]
+		self._changed(e.key)
+		ip = e.key >> 16
+		n = self.by_ip[ip] - 1
+		if n > 0:
+			self.by_ip[ip] = n
+		else:
+			del self.by_ip[ip]
+		self._index_tags(e, False)
+		if self.federation != None and e.origin == None:
+			self.federation.remove(e.key)
+
+	def _index_tags(self, e, add):
+		"""Add or remove the given entry's tags in the tag index."""
+		for t in e.tag_list():
+			keys = self.by_tag.get(t)
+			if add:
+				if keys == None:
+					self.by_tag[t] = set([e.key])
+				else:
+					keys.add(e.key)
+			elif keys != None:
+				keys.discard(e.key)
+				if len(keys) == 0:
+					del self.by_tag[t]
 
 	def description(self, ip, tail):
+		key = pack_address(ip)
+		if key == None:
+			return
 		# Check if the IP is for a known server.
-		if self.servers.has_key(ip):
+		old = self.servers.get(key)
+		if old != None and old.origin == None:
 			# Yes, so just touch the entry to keep it alive.
-			e = self.servers[ip]
-			e.touch()
+			self._touch(old)
+			self.stats.count("description.known")
 			return
 		# If unknown, see if it's in the queue of servers wanting in.
-		if self.queue.unqueue(ip):
-			e = Database.Entry(ip)
-			self.servers[e.key] = e
+		if not self.queue.unqueue(ip):
+			self.stats.count("description.unmatched")
+		else:
+			self.stats.count("description.matched")
+			e = Database.Entry(key)
 			e.touch()
 			pa = self._parse(tail)
 			if pa != None and pa.has_key("DE"):
 				e.set_desc(pa["DE"])
 			if pa != None and pa.has_key("TA"):
 				e.set_tags(pa["TA"])
-			print "Registered server at", ip, "now %u registered" % len(self.servers)
+				self.log.debug("Tags of %s now: %s", ip, e.tags)
+			if self.owner != None:		# Registered once the owner sends it back.
+				self.owner.put(("add", key, e.desc, e.tags, e.time))
+				return
+			if old != None:
+				self._unregister(old)	# Replace copy from a peer master.
+			self._register(e)
+			self.log.info("Registered server at %s now %u registered", ip, len(self.servers))
 
 	def _parse_get_tags(self, tags):
 		"""Parse a list of tags, which can include minus to exclude a tag. Returns a pair
@@ -341,6 +1504,8 @@ class Database:
 		incl = []
 		excl = []
 		for t in tags.split(","):
+			if t == "":
+				continue
 			if t[0] == '-':
 				if is_tag(t[1:]):
 					excl += [t[1:]]
@@ -352,93 +1517,522 @@ class Database:
 		excl = [e for e in excl if not e in incl]
    		return (incl, excl)
 
-	def _build_list(self, what, incl, excl):
-		"""Build a list of MS:LIST packets, according to the given parameters."""
-		packets = []
-		pack = "MS:LIST"
-
-#		print "building packet list,", len(self.servers.values()), "servers"		
-		for e in self.servers.values():
-			this = ""
-			if e.filter_tags(incl, excl):
-				h = e.build_list(what)
-				if len(pack) + len(h) > 1390:
-					packets += [pack]
-					pack = "MS:LIST"
-				pack += h
-		if pack != "MS:LIST":
-			packets += [pack]
+	def _select(self, incl, excl):
+		"""Return the registered entries having all tags in incl, and none of those in excl.
+		   With tags to include, the work done is bounded by the rarest of them."""
+		excluded = set()
+		if excl:
+			for t in excl:
+				excluded.update(self.by_tag.get(t, ()))
+		if incl:
+			sets = [self.by_tag.get(t) for t in incl]
+			if None in sets:
+				return []
+			sets.sort(key = len)
+			keys = sets[0].intersection(*sets[1:])
+			keys.difference_update(excluded)
+			return [self.servers[k] for k in keys]
+		if len(excluded) == 0:
+			return self.servers.values()
+		return [e for e in self.servers.values() if not e.key in excluded]
+
+	def _matches(self, e, incl, excl):
+		"""Check a single entry against tags to include and exclude, like _select() does."""
+		tags = e.tag_list()
+		for t in incl or ():
+			if not t in tags:
+				return False
+		for t in excl or ():
+			if t in tags:
+				return False
+		return True
+
+	def _pack(self, fragments, header = "MS:LIST", ordered = False):
+		"""Pack list fragments into as few packets as possible, each starting with the header
+		   and no larger than packet_size, or if ordered, into packets in the order given. Returns
+		   a tuple. Each packet has PK=i/n after the header, numbering it from 1 to n, and the last
+		   also has EN=1, so clients can tell when they have the whole list; an empty list is sent
+		   as just those. Parsers skip keys before the first IP."""
+		most = max(1, len(fragments))		# Packets there can be, at the most.
+		pack = [pack_fragments, pack_in_order][ordered]
+		bins, dropped = pack(fragments, self.packet_size - len(header) - len(" EN=1 PK=%u/%u" % (most, most)))
+		if dropped > 0:
+			self.stats.count("list.oversized", dropped)
+		bins = bins or [[]]
+		packets = ["%s PK=%u/%u%s" % (header, i + 1, len(bins), "".join(b)) for i, b in enumerate(bins)]
+		packets[-1] = header + " EN=1" + packets[-1][len(header):]
+		return tuple(packets)
+
+	def _build_delta(self, what, incl, excl, token):
+		"""Build MS:LIST packets holding just what changed since the generation in the token,
+		   as entries and RM=IP removals. If the token is too old, or from another run, all
+		   entries are sent, flagged with FU=1. Every packet starts with the current token."""
+		epoch, dot, gen = token.partition(".")
+		try:
+			epoch, gen = int(epoch), int(gen)
+		except ValueError:
+			epoch = None
+		current = "%u.%u" % (self.epoch, self.generation)
+		if epoch != self.epoch or gen < self.changelog_floor or gen > self.generation:
+			self.stats.count("get.delta.full")
+			return self._build_list(what, incl, excl, "MS:LIST GE=%s FU=1" % current)
+		self.stats.count("get.delta")
+		query, packets = self._cached_list(what, incl, excl, "GE=%u" % gen)
+		if packets != None:
+			return packets
+		keys = set()
+		for g, key in reversed(self.changelog):
+			if g <= gen:
+				break
+			keys.add(key)
+		fragments = []
+		for key in keys:
+			e = self.servers.get(key)
+			if e != None and self._matches(e, incl, excl):
+				fragments.append(e.build_list(what))
+			else:
+				fragments.append(" RM=" + list_address(key))
+		return self._cache_list(query, self._pack(fragments, "MS:LIST GE=%s" % current))
+
+	def _cached_list(self, what, incl, excl, variant):
+		"""Look up a packet list in the cache. Returns (query, packets), where packets is None
+		   if not cached; pass the query to _cache_list() once it's built. The cache is dropped
+		   whenever the registry generation changes, and within one it's least-recently-used."""
+		if self.lists_generation != self.generation:
+			self.lists = msparse.Cache(LIST_CACHE_SIZE)
+			self.lists_generation = self.generation
+		fields = what.get("IP")
+		if fields != None:
+			fields = tuple(fields)
+		if incl != None:
+			incl = tuple(sorted(incl))
+		if excl != None:
+			excl = tuple(sorted(excl))
+		query = (fields, incl, excl, variant)
+		return query, self.lists.get(query)
+
+	def _cache_list(self, query, packets):
+		self.lists.put(query, packets)
 		return packets
 
+	def _build_list(self, what, incl, excl, header = "MS:LIST", limit = None, after = None, fresh = False):
+		"""Build a list of MS:LIST packets, according to the given parameters. The result is
+		   shared by all GETs for the same query, through the cache, so it must not be modified.
+		   With a limit, only that many entries are built and packed. If fresh, they are the most
+		   recently seen ones, listed in that order. Otherwise they are the ones with the lowest
+		   keys above after, if given, and if entries are left out, each packet has NX= the last
+		   address listed. Passed back as after, that pages through the list in address order,
+		   which stays stable however the registry changes."""
+		variant = header
+		if limit != None or after != None or fresh:
+			bucket = None
+			if fresh:
+				bucket = int(time.time() / ORDER_REFRESH)	# Times seen change without a new generation.
+			variant = "%s MX=%s NX=%s OR=%s" % (header, limit, after, bucket)
+		query, packets = self._cached_list(what, incl, excl, variant)
+		if packets != None:
+			return packets
+		t0 = time.time()
+		entries = self._select(incl, excl)
+		if fresh:
+			if limit != None:
+				entries = heapq.nlargest(limit, entries, key = lambda e: e.time)
+			else:
+				entries = sorted(entries, key = lambda e: e.time, reverse = True)
+		else:
+			if after != None:
+				entries = [e for e in entries if e.key > after]
+			if limit != None and len(entries) > limit:
+				entries = heapq.nsmallest(limit, entries, key = lambda e: e.key)
+				header += " NX=" + list_address(entries[-1].key)
+		packets = self._pack([e.build_list(what) for e in entries], header, fresh)
+		self.stats.time("build_list", time.time() - t0)
+		return self._cache_list(query, packets)
+
 	def get(self, ip, args = None):
+		"""Answer a GET. Besides IP=fields and TA=tags, MX=N limits the list to N servers, OR=SEEN
+		   picks the most recently seen ones first, and NX=IP[:PORT] continues a list after an
+		   earlier one's NX, see _build_list(). Delta GETs, with GE=token, are never limited."""
 		what = { }
 		incl = None
 		excl = None
+		token = None
+		limit = None
+		after = None
+		fresh = False
 		if args != None:
 			pa = self._parse(args)
 			if pa != None and pa.has_key("IP"):
 				what["IP"] = [ f for f in pa["IP"].split(",") ]
 			if pa != None and pa.has_key("TA"):
 				incl, excl = self._parse_get_tags(pa["TA"])
-		packets = self._build_list(what, incl, excl)
-		self.listjobs.add(ip, packets)
-		self.gets += 1
+			if pa != None and pa.has_key("GE"):
+				token = pa["GE"]
+			if pa != None and pa.has_key("MX"):
+				try:
+					limit = max(1, int(pa["MX"]))
+				except ValueError:
+					pass
+			if pa != None and pa.has_key("NX"):
+				after = pack_address(pa["NX"])
+			if pa != None and pa.has_key("OR"):
+				fresh = pa["OR"] == "SEEN"
+		if token == None:
+			if limit != None or after != None or fresh:
+				self.stats.count("get.limited")
+			packets = self._build_list(what, incl, excl, limit = limit, after = after, fresh = fresh)
+		else:
+			packets = self._build_delta(what, incl, excl, token)
+		if not self.listjobs.add(ip, packets, args):
+			self.stats.count("get.rejected.jobs_per_ip")
+			self.log.limited("get.ignored", LOG_INFO, "Ignoring GET from %s, already sending it %u lists", ip, self.listjobs.max_per_ip)
+			return
+		self.stats.count("get.served")
 
 	def flush(self):
+		self.queue.flush(time.time())
 		self.listjobs.flush()
+		self.log.flush()
+		if self.capture != None and not self.capture.flush():
+			self.capture = None
 
 	def clean(self):
-		"""Throw out servers that haven't pinged us in a while."""
-		i = 0
+		"""Throw out servers that haven't pinged us in a while. Only entries whose deadline has
+		   passed are looked at; touched ones are simply pushed back with their new deadline."""
 		now = time.time()
-		for e in self.servers.values():
+		while self.owner == None and len(self.expiry) > 0 and self.expiry[0][0] <= now:
+			deadline, e = heapq.heappop(self.expiry)
+			if self.servers.get(e.key) is not e:
+				continue		# Stale heap item, entry already gone.
 			if now - e.time >= SERVER_TIMEOUT:
-				print "Dropping", e.key + ", expired after %.1f seconds" % (now - e.time)
-				del self.servers[e.key]
-		if self.talk and now - self.talked_last > 10.0:
-			print "There are now %u unique servers registered. %u GETs serviced" % (len(self.servers), self.gets)
+				self.log.info("Dropping %s, expired after %.1f seconds", e.address(), now - e.time)
+				self._unregister(e)
+				self.stats.count("expired")
+			else:
+				heapq.heappush(self.expiry, (e.time + SERVER_TIMEOUT, e))
+		if self.log.enabled(LOG_INFO) and now - self.talked_last > 10.0:
+			self.log.info("There are now %u unique servers registered. %u GETs serviced", len(self.servers), self.stats.counters.get("get.served", 0))
 			self.talked_last = now
+		if self.snapshot != None:
+			self.snapshot.poll(now)
+		if self.federation != None:
+			self.federation.flush(now)
+
+	def next_deadline(self):
+		"""Return the earliest time at which flush() or clean() has work to do, or None."""
+		t = self.listjobs.next_deadline()
+		for d in (self.queue.next_deadline(), self.log.next_deadline()):
+			if d != None and (t == None or d < t):
+				t = d
+		if len(self.expiry) > 0 and (t == None or self.expiry[0][0] < t):
+			t = self.expiry[0][0]
+		if self.log.enabled(LOG_INFO) and (t == None or self.talked_last + 10.0 < t):
+			t = self.talked_last + 10.0
+		if self.snapshot != None and (t == None or self.snapshot.due < t):
+			t = self.snapshot.due
+		if self.federation != None and (t == None or self.federation.next_deadline() < t):
+			t = self.federation.next_deadline()
+		if self.capture != None and self.capture.due != None and (t == None or self.capture.due < t):
+			t = self.capture.due
+		return t
+
+	def send_stats(self, address):
+		"""Send MS:STATS packets with all counters, gauges and histograms to the given address."""
+		gauges = { "servers": len(self.servers), "queue.pending": self.queue.get_load(),
+			"list.jobs": len(self.listjobs.jobs), "list.cached": len(self.lists) }
+		pack = "MS:STATS"
+		for line in self.stats.report(gauges):
+			if len(pack) + 1 + len(line) > self.packet_size:
+				self.transport.send(address, pack)
+				pack = "MS:STATS"
+			pack += "\n" + line
+		self.transport.send(address, pack)
+
+	def run(self):
+		"""Serve forever. flush() and clean() are only called once next_deadline() has passed;
+		   until then, the transport waits for pings. Each phase of the main loop is timed."""
+		st = self.stats
+		prof = self.profiler
+		while 1:
+			t0 = time.time()
+			due = self.next_deadline()
+			if due != None and due <= t0:
+				self.flush()
+				t1 = time.time()
+				self.clean()
+				t2 = time.time()
+				st.time("loop.flush", t1 - t0)
+				st.time("loop.clean", t2 - t1)
+				due = self.next_deadline()
+			else:
+				t1 = t2 = t0
+				st.count("loop.idle")
+			self.transport.wait(due)
+			if self.owner != None:
+				try:
+					self.owner.flush()
+				except socket.error:
+					self._lost_owner()
+			t3 = time.time()
+			st.time("loop.wait", t3 - t2)
+			if prof != None:
+				prof.turn(t1 - t0, t2 - t1, t3 - t2)
+				prof.poll()
 
 	def _cb_ping(self, address, message):
-		address = self._replace_local(address)
+		if self.capture != None:
+			self.capture.record(address, message)
+		if message.startswith("MS:STATS"):	# Only answered locally, checked before remapping.
+			if address.startswith("127."):
+				self.send_stats(address)
+			else:
+				self.stats.count("stats.refused")
+			return
+		if message.startswith("MS:SYNC") or message.startswith("MS:RESYNC"):
+			if self.federation != None:
+				self.federation.receive(address, message)
+			return
 		if message.startswith("MS:ANNOUNCE"):
-			self.announce(address)
+			kind = "announce"
 		elif message.startswith("MS:GET"):
-			self.get(address, message[6:])
+			kind = "get"
 		elif message.startswith("DESCRIPTION "):
+			kind = "description"
+		else:
+			self.log.limited("ping.unknown", LOG_INFO, "Master server ignoring unknown ping '%s' from %s", message, address)
+			return
+		if self.limiter != None and not self.limiter.admit(kind, address, time.time()):
+			return		# Checked on the real source, before remapping.
+		address = self._replace_local(address)
+		if kind == "announce":
+			self.announce(address)
+		elif kind == "get":
+			self.get(address, message[6:])
+		else:
 			self.description(address, message[12:])
+
+class Owner:
+	"""Owns the registry when the master runs as several worker processes sharing one UDP port.
+	   Workers send it registrations and touches; it enforces MAX_PER_IP and expiry for all of
+	   them, and sends every change on to every worker. Each worker keeps a replica, from which
+	   it answers GETs on its own. Only the cap on registered servers is global, though: each
+	   worker queues servers for DESCRIBE on its own, so with N workers up to N * MAX_PER_IP
+	   servers from one IP can be waiting to be described at once."""
+	def __init__(self, level = LOG_INFO):
+		self.log = Log(level)
+		self.workers = []
+		self.pids = []		# Process IDs of workers, for passing signals on.
+		self.servers = {}	# Maps packed address to [desc, tags, time].
+		self.by_ip = {}		# Maps packed bare IP to number of servers registered from it.
+		self.expiry = []	# Heap of (deadline, key, record), lazily re-checked in clean().
+		self.stats = Stats()
+		self.snapshot = None
+
+	def add_worker(self, channel, pid = None):
+		self.workers.append(channel)
+		if pid != None:
+			self.pids.append(pid)
+
+	def forward_signals(self, signals):
+		"""Pass the given signals on to all workers, rather than being stopped by them. Lets
+		   one kill of the main process toggle every worker's Profiler."""
+		for sig in signals:
+			signal.signal(sig, self._forward)
+			signal.siginterrupt(sig, False)
+
+	def _forward(self, sig, frame):
+		for pid in self.pids:
+			try:
+				os.kill(pid, sig)
+			except OSError:
+				pass		# Gone; noticed when its channel closes.
+
+	def set_snapshot(self, path, period = SNAPSHOT_PERIOD):
+		self.snapshot = Snapshotter(path, lambda: [(k, r[0], r[1], r[2]) for k, r in self.servers.iteritems()], self.stats, self.log, period)
+
+	def load_snapshot(self, path):
+		try:
+			records = read_snapshot(path)
+		except (IOError, OSError, ValueError, EOFError, TypeError), x:
+			self.log.error("Couldn't load snapshot: %s", x)
+			return
+		now = time.time()
+		for key, desc, tags, t in records:
+			if now - t < SERVER_TIMEOUT:
+				self._add(key, desc, tags, t)
+		self.log.info("Restored %u servers from %s", len(self.servers), path)
+
+	def _broadcast(self, op):
+		for w in self.workers:
+			w.put(op)
+
+	def _add(self, key, desc, tags, t):
+		if not self.servers.has_key(key):
+			ip = key >> 16
+			n = self.by_ip.get(ip, 0)
+			if n >= MAX_PER_IP:
+				self.stats.count("register.rejected.registered_per_ip")
+				return
+			self.by_ip[ip] = n + 1
+			self.log.info("Registered server at %s now %u registered", unpack_address(key), len(self.servers) + 1)
+		rec = [desc, tags, t]
+		self.servers[key] = rec
+		heapq.heappush(self.expiry, (t + SERVER_TIMEOUT, key, rec))
+		self._broadcast(("add", key, desc, tags, t))
+
+	def _touch(self, key, t):
+		rec = self.servers.get(key)
+		if rec != None and t > rec[2]:
+			rec[2] = t
+			self._broadcast(("touch", key, t))
+
+	def _remove(self, key):
+		del self.servers[key]
+		ip = key >> 16
+		n = self.by_ip[ip] - 1
+		if n > 0:
+			self.by_ip[ip] = n
 		else:
-			print "Master server ignoring unknown ping '%s' from %s" % (message, address)
+			del self.by_ip[ip]
+		self._broadcast(("del", key))
+
+	def clean(self, now):
+		while len(self.expiry) > 0 and self.expiry[0][0] <= now:
+			deadline, key, rec = heapq.heappop(self.expiry)
+			if self.servers.get(key) is not rec:
+				continue		# Stale heap item.
+			if now - rec[2] >= SERVER_TIMEOUT:
+				self.log.info("Dropping %s, expired after %.1f seconds", unpack_address(key), now - rec[2])
+				self._remove(key)
+			else:
+				heapq.heappush(self.expiry, (rec[2] + SERVER_TIMEOUT, key, rec))
+		if self.snapshot != None:
+			self.snapshot.poll(now)
+
+	def next_deadline(self):
+		t = None
+		if len(self.expiry) > 0:
+			t = self.expiry[0][0]
+		if self.snapshot != None and (t == None or self.snapshot.due < t):
+			t = self.snapshot.due
+		return t
+
+	def _lost_worker(self):
+		self.log.error("A worker process went away, exiting")
+		self.log.close()
+		sys.exit(1)
+
+	def run(self):
+		"""Serve the workers forever. Exits if one of them goes away."""
+		socks = dict([(w.sock, w) for w in self.workers])
+		while 1:
+			self.clean(time.time())
+			for w in self.workers:
+				try:
+					w.flush()
+				except socket.error:
+					self._lost_worker()
+			self.log.flush()
+			timeout = None
+			deadline = self.next_deadline()
+			if deadline != None:
+				timeout = max(0.0, deadline - time.time())
+			try:
+				r, w, x = select.select(socks.keys(), [w.sock for w in self.workers if w.pending()], [], timeout)
+			except select.error, e:
+				if e.args[0] == errno.EINTR:
+					continue	# A signal passed on to the workers.
+				raise
+			for sock in r:
+				try:
+					ops = socks[sock].receive()
+				except (EOFError, socket.error):
+					self._lost_worker()
+				for op in ops:
+					if op[0] == "touch":
+						self._touch(op[1], op[2])
+					elif op[0] == "add":
+						self._add(op[1], op[2], op[3], op[4])
 
 def usage():
 	print "Verse Master Server, for keeping track of where Verse servers"
 	print "are running. See <http://verse.blender.org/> for more on Verse."
 	print "Options:"
+	print " -c FILE or --capture=FILE\tAppend every incoming ping to FILE, for replay.py."
+	print " -d or --debug\t\tAlso log every ping handled, and every list sent."
 	print " -h or --help\t\tThis text."
+	print " -j N or --workers=N\tRun N worker processes on the same port. Needs socket transport."
 	print " -l IP or --local=IP\tSet address to replace 127.0.0.1 with."
+	print " -L or --no-limits\tDon't rate-limit incoming pings per IP and subnet."
+	print " -m MTU or --mtu=MTU\tSet max datagram size, headers included. %u to %u, the default." % (MTU_MIN, PACKET_MTU)
 	print " -p PORT or --port=PORT\tSet port number to listen to."
-	print " -q or --quiet\t\tDisable status messages."
+	print " -P IP[:PORT] or --peer=IP[:PORT]\tReplicate servers with peer master. Repeat for more."
+	print " -q or --quiet\t\tOnly log errors."
+	print " -R FILE or --profile=FILE\tProfile the main loop on SIGUSR1, until the next. Written to FILE."
+	print "\t\t\tWith -j, signal a worker to profile it alone, to FILE.N, or the main"
+	print "\t\t\tprocess to have the signal passed on to all workers."
+	print " -s FILE or --snapshot=FILE\tPeriodically save registry to FILE."
+	print " -r RATE or --rate=RATE\tSet max number of MS:LIST packets sent per second."
+	print " -t NAME or --transport=NAME\tSet network transport, 'verse' or 'socket'."
 	print " -v or --version\tPrint version number and exit."
+	print " -w or --warm\t\tRestore registry from snapshot FILE at start-up."
 
 if __name__ == "__main__":
 	try:
-		opts, args = getopt.getopt(sys.argv[1:], "hp:qvl:", ["help", "quiet", "port=", "version", "local="])
+		opts, args = getopt.getopt(sys.argv[1:], "c:dhj:m:p:P:qR:r:s:t:vwl:L", ["capture=", "debug", "help", "workers=", "mtu=", "no-limits", "quiet", "profile=", "port=", "peer=", "rate=", "snapshot=", "transport=", "version", "warm", "local="])
 	except getopt.GetoptError:
 		usage()
 		sys.exit(2)
-	talk = True
+	level = LOG_INFO
 	port = VERSE_PORT	# By default, run the master server on the standard Verse port. Simplifies for clients.
 	local = "127.0.0.1"	# Incoming requests from localhost are replaced by this.
+	rate = LIST_RATE
+	snapshot = None
+	capture = None
+	profile = None
+	warm = False
+	workers = 1
+	limits = LIMITS
+	mtu = PACKET_MTU
+	peers = []
+	transport = "verse"
+	if v == None:
+		transport = "socket"
 	for o, a in opts:
 		if o in ["-h", "--help"]:
 			usage()
 			sys.exit()
-		if o in ["-l", "--local"]:
+		if o in ["-c", "--capture"]:
+			capture = a
+		elif o in ["-d", "--debug"]:
+			level = LOG_DEBUG
+		elif o in ["-j", "--workers"]:
+			workers = int(a)
+		elif o in ["-l", "--local"]:
 			local = a
+		elif o in ["-m", "--mtu"]:
+			mtu = int(a)
+			if mtu < MTU_MIN or mtu > PACKET_MTU:
+				print "MTU must be %u to %u." % (MTU_MIN, PACKET_MTU)
+				sys.exit(2)
+		elif o in ["-L", "--no-limits"]:
+			limits = None
 		elif o in ["-q", "--quiet"]:
-			talk = False
+			level = LOG_ERROR
 		elif o in ["-p", "--port"]:
 			port = int(a)
+		elif o in ["-R", "--profile"]:
+			profile = a
+		elif o in ["-P", "--peer"]:
+			peers.append(a)
+		elif o in ["-r", "--rate"]:
+			rate = float(a)
+		elif o in ["-s", "--snapshot"]:
+			snapshot = a
+		elif o in ["-t", "--transport"]:
+			transport = a
+		elif o in ["-w", "--warm"]:
+			warm = True
 		elif o in ["-v", "--version"]:
 			print VERSION
 			sys.exit()
@@ -446,10 +2040,60 @@ if __name__ == "__main__":
 	print "Verse Master Server v%s by Emil Brink (c) 2005-2006 PDC, KTH." % VERSION
 	print "Licensed under the BSD License."
 
-	db = Database(port, talk)
+	if workers > 1:
+		if transport != "socket" or not hasattr(os, "fork") or len(peers) > 0:
+			print "Worker processes need the socket transport, and fork(), and can't have peers."
+			sys.exit(2)
+		owner = Owner(level)
+		for i in xrange(workers):
+			ours, theirs = socket.socketpair()
+			pid = os.fork()
+			if pid == 0:
+				ours.close()
+				for w in owner.workers:
+					w.sock.close()
+				db = Database(port, level, SocketTransport(reuse = True))
+				db.set_local(local)
+				db.set_list_rate(rate / workers)
+				db.set_limits(limits)
+				db.set_mtu(mtu)
+				db.set_owner(Channel(theirs))
+				if capture != None:
+					db.set_capture("%s.%u" % (capture, i))	# One file per worker, writes don't interleave.
+				if profile != None:
+					db.set_profiler("%s.%u" % (profile, i))
+				db.run()
+			theirs.close()
+			owner.add_worker(Channel(ours), pid)
+		if profile != None:
+			owner.forward_signals([signal.SIGUSR1, signal.SIGUSR2])
+		if snapshot != None:
+			if warm:
+				owner.load_snapshot(snapshot)
+			owner.set_snapshot(snapshot)
+		owner.run()
+
+	if transport == "verse":
+		transport = VerseTransport()
+	elif transport == "socket":
+		transport = SocketTransport()
+	else:
+		usage()
+		sys.exit(2)
+	db = Database(port, level, transport)
 	db.set_local(local)
+	db.set_list_rate(rate)
+	db.set_limits(limits)
+	db.set_mtu(mtu)
+	if capture != None:
+		db.set_capture(capture)
+	if profile != None:
+		db.set_profiler(profile)
+	if len(peers) > 0:
+		db.set_peers(peers)
+	if snapshot != None:
+		if warm:
+			db.load_snapshot(snapshot)
+		db.set_snapshot(snapshot)
 
-	while 1:
-		db.flush()
-		db.clean()
-		v.callback_update(2500)
+	db.run()